@@ -1,9 +1,10 @@
 """Londiste setup and sanity checker.
 """
 
-from typing import Optional, Sequence, Dict, List, Any, cast
+from typing import Optional, Sequence, Dict, List, Set, Tuple, Iterator, Any, cast
 
 import os
+import fnmatch
 import re
 import sys
 import optparse
@@ -26,6 +27,16 @@ from .util import find_copy_source
 
 __all__ = ['LondisteSetup']
 
+# rows per round-trip when streaming catalog via server-side cursor
+CATALOG_FETCH_SIZE = 500
+
+# tables registered per transaction in add-table,
+# tables that get created are committed one by one
+ADD_TABLE_BATCH = 200
+
+# row event op -> counter position in resurrect stats
+_EV_OP_TABLE = {'I': 0, 'U': 1, 'D': 2}
+
 
 class LondisteSetup(CascadeAdmin):
     """Londiste-specific admin commands."""
@@ -41,6 +52,9 @@ class LondisteSetup(CascadeAdmin):
     register_skip_tables: Optional[Sequence[str]] = None
     register_skip_seqs: Optional[Sequence[str]] = None
 
+    # (handler, handler_args) -> (handler_string, needs_table)
+    _handler_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, bool]]
+
     def install_code(self, db: Connection) -> None:
         self.extra_objs = [
             skytools.DBSchema("londiste", sql='create extension londiste'),
@@ -62,11 +76,23 @@ class LondisteSetup(CascadeAdmin):
 
         self.lock_timeout = self.cf.getfloat('lock_timeout', 10)
 
+        # read table/seq lists via server-side cursor
+        self.streaming_catalog_fetch = self.cf.getboolean('streaming_catalog_fetch', False)
+
+        # number of connections for registering tables
+        self.admin_parallel = self.cf.getint('admin_parallel', 1)
+
+        # --wait-sync poll interval, grows while nothing finishes
+        self.wait_sync_min = self.cf.getfloat('wait_sync_min', 0.25)
+        self.wait_sync_max = self.cf.getfloat('wait_sync_max', 2)
+
         self.register_only_tables = self.cf.getlist("register_only_tables", [])
         self.register_only_seqs = self.cf.getlist("register_only_seqs", [])
         self.register_skip_tables = self.cf.getlist("register_skip_tables", [])
         self.register_skip_seqs = self.cf.getlist("register_skip_seqs", [])
 
+        self._handler_cache = {}
+
         load_handler_modules(self.cf)
 
     def init_optparse(self, parser: Optional[optparse.OptionParser] = None) -> optparse.OptionParser:
@@ -122,35 +148,49 @@ class LondisteSetup(CascadeAdmin):
         pcurs = provider_db.cursor()
         ncurs = node_db.cursor()
 
-        # sync tables
+        # sync tables, register all of them in one round-trip
         q = "select table_name from londiste.get_table_list(%s)"
         pcurs.execute(q, [self.set_name])
-        for row in pcurs.fetchall():
-            tbl = row['table_name']
-            if self.register_only_tables and tbl not in self.register_only_tables:
-                continue
-            if self.register_skip_tables and tbl in self.register_skip_tables:
-                continue
-            q = "select * from londiste.global_add_table(%s, %s)"
-            ncurs.execute(q, [self.set_name, tbl])
+        tbl_list = [
+            row['table_name'] for row in pcurs.fetchall()
+            if self.register_table_allowed(row['table_name'])
+        ]
+        if tbl_list:
+            q = "select r.* from unnest(%s::text[]) t (tbl),"\
+                " londiste.global_add_table(%s, t.tbl) r"
+            ncurs.execute(q, [tbl_list, self.set_name])
 
         # sync seqs
         q = "select seq_name, last_value from londiste.get_seq_list(%s)"
         pcurs.execute(q, [self.set_name])
-        for row in pcurs.fetchall():
-            seq = row['seq_name']
-            val = row['last_value']
-            if self.register_only_seqs and seq not in self.register_only_seqs:
-                continue
-            if self.register_skip_seqs and seq in self.register_skip_seqs:
-                continue
-            q = "select * from londiste.global_update_seq(%s, %s, %s)"
-            ncurs.execute(q, [self.set_name, seq, val])
+        seq_rows = [row for row in pcurs.fetchall() if self.register_seq_allowed(row['seq_name'])]
+        seq_list = [row['seq_name'] for row in seq_rows]
+        val_list = [row['last_value'] for row in seq_rows]
+        if seq_list:
+            q = "select r.* from unnest(%s::text[], %s::int8[]) s (seq, val),"\
+                " londiste.global_update_seq(%s, s.seq, s.val) r"
+            ncurs.execute(q, [seq_list, val_list, self.set_name])
 
         # done
         node_db.commit()
         provider_db.commit()
 
+    def register_table_allowed(self, tbl: str) -> bool:
+        """Check register_only_tables / register_skip_tables."""
+        if self.register_only_tables and tbl not in self.register_only_tables:
+            return False
+        if self.register_skip_tables and tbl in self.register_skip_tables:
+            return False
+        return True
+
+    def register_seq_allowed(self, seq: str) -> bool:
+        """Check register_only_seqs / register_skip_seqs."""
+        if self.register_only_seqs and seq not in self.register_only_seqs:
+            return False
+        if self.register_skip_seqs and seq in self.register_skip_seqs:
+            return False
+        return True
+
     def is_root(self) -> bool:
         assert self.queue_info
         return self.queue_info.local_node.type == 'root'
@@ -166,17 +206,16 @@ class LondisteSetup(CascadeAdmin):
         """Attach table(s) to local node."""
 
         self.load_local_info()
+        is_root = self.is_root()
 
         src_db = self.get_provider_db()
-        if not self.is_root():
-            src_curs = src_db.cursor()
-            src_tbls = self.fetch_set_tables(src_curs)
-            src_db.commit()
+        if not is_root:
+            src_tbls = self.fetch_provider_tables(src_db)
 
         dst_db = self.get_database('db')
         dst_curs = dst_db.cursor()
         dst_tbls = self.fetch_set_tables(dst_curs)
-        if self.is_root():
+        if is_root:
             src_tbls = dst_tbls
         else:
             self.sync_table_list(dst_curs, src_tbls, dst_tbls)
@@ -184,6 +223,7 @@ class LondisteSetup(CascadeAdmin):
 
         needs_tbl = self.handler_needs_table()
         args = self.expand_arg_list(dst_db, 'r', False, tables, needs_tbl)
+        args = [skytools.fq_name(tbl) for tbl in args]
 
         # pick proper create flags
         if self.options.create_full:
@@ -195,22 +235,22 @@ class LondisteSetup(CascadeAdmin):
 
         # search for usable copy node if requested & needed
         if (self.options.find_copy_node and create_flags != 0
-                and needs_tbl and not self.is_root()):
+                and needs_tbl and not is_root):
             assert self.queue_name
             assert self.provider_location
-            src_name, _, _ = find_copy_source(self, self.queue_name, args, "?", self.provider_location)
+            src_name, src_location, _ = find_copy_source(self, self.queue_name, args, "?", self.provider_location)
             self.options.copy_node = src_name
-            self.close_database('provider_db')
-            src_db = self.get_provider_db()
-            src_curs = src_db.cursor()
-            src_tbls = self.fetch_set_tables(src_curs)
-            src_db.commit()
+            # provider itself is usable - keep connection and table list
+            if src_location != self.provider_location:
+                # cached connection would reconnect to old location
+                self.close_database('provider_db')
+                src_db = self.get_provider_db()
+                src_tbls = self.fetch_provider_tables(src_db)
 
         # dont check for exist/not here (root handling)
-        if not self.is_root() and not self.options.expect_sync and not self.options.find_copy_node:
+        if not is_root and not self.options.expect_sync and not self.options.find_copy_node:
             problems = False
             for tbl in args:
-                tbl = skytools.fq_name(tbl)
                 if (tbl in src_tbls) and not src_tbls[tbl]['local']:
                     if self.options.skip_non_existing:
                         self.log.warning("Table %s does not exist on provider", tbl)
@@ -227,26 +267,130 @@ class LondisteSetup(CascadeAdmin):
             sys.exit(1)
 
         # seems ok
-        for tbl in args:
-            self.add_table(src_db, dst_db, tbl, create_flags, src_tbls)
+        tgargs = self.build_tgargs()
+        batch_size = 1 if create_flags else ADD_TABLE_BATCH
+        batch_list = [args[i : i + batch_size] for i in range(0, len(args), batch_size)]
+        if self.admin_parallel > 1 and len(batch_list) > 1 and not create_flags:
+            self.add_tables_parallel(batch_list, src_tbls, tgargs)
+        else:
+            for batch in batch_list:
+                self.add_tables(src_db, dst_db, batch, create_flags, src_tbls, tgargs)
 
         # wait
         if self.options.wait_sync:
             self.wait_for_sync(dst_db)
 
-    def add_table(self, src_db: Connection, dst_db: Connection, tbl: str, create_flags: int, src_tbls: Dict[str, DictRow]) -> None:
-        # use full names
-        tbl = skytools.fq_name(tbl)
-        dest_table = self.options.dest_table or tbl
-        dest_table = skytools.fq_name(dest_table)
-
-        src_curs = src_db.cursor()
+    def add_tables_parallel(self, batch_list: Sequence[Sequence[str]],
+                            src_tbls: Dict[str, DictRow], base_tgargs: Sequence[str]) -> None:
+        """Register table batches over several connections.
+
+        Only for plain registration, table creation is not done here,
+        so provider connection is not needed.  Each batch is committed
+        in its own transaction, on first failure batches not yet
+        started are cancelled.
+        """
+        import concurrent.futures
+        import queue
+
+        nworkers = min(self.admin_parallel, len(batch_list))
+        dbname_list = ['db_add_%d' % i for i in range(nworkers)]
+        db_pool: "queue.Queue[Connection]" = queue.Queue()
+        for dbname in dbname_list:
+            db_pool.put(self.get_database(dbname, connstr=self.cf.get('db')))
+
+        def add_worker(tables: Sequence[str]) -> None:
+            # pool size equals thread count, so there is always a free connection
+            dst_db = db_pool.get()
+            try:
+                self.add_tables(None, dst_db, tables, 0, src_tbls, base_tgargs)
+            finally:
+                db_pool.put(dst_db)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as executor:
+                futures = [executor.submit(add_worker, tables) for tables in batch_list]
+                done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+                failed = [f for f in done if f.exception() is not None]
+                if failed:
+                    for f in pending:
+                        f.cancel()
+                    concurrent.futures.wait(pending)
+                    committed = [tbl for tables, f in zip(batch_list, futures)
+                                 if not f.cancelled() and f.exception() is None
+                                 for tbl in tables]
+                    if committed:
+                        self.log.info("Registered before failure: %s", ", ".join(committed))
+                    exc = failed[0].exception()
+                    assert exc is not None
+                    raise exc
+        finally:
+            for dbname in dbname_list:
+                self.close_database(dbname)
+
+    def add_tables(self, src_db: Optional[Connection], dst_db: Connection, tables: Sequence[str], create_flags: int,
+                   src_tbls: Dict[str, DictRow], base_tgargs: Sequence[str]) -> None:
+        """Register batch of tables in one transaction.
+
+        Table names must be fully-qualified.  Provider connection
+        is used only when tables are created.
+        """
         dst_curs = dst_db.cursor()
-        tbl_exists = skytools.exists_table(dst_curs, dest_table)
+
+        name_list = []
+        for tbl in tables:
+            dest_table = tbl
+            if self.options.dest_table:
+                dest_table = skytools.fq_name(self.options.dest_table)
+            name_list.append((tbl, dest_table))
+
+        # existence checks for whole batch
+        dst_tables, dst_schemas = self.probe_tables(dst_curs, [dest_table for _, dest_table in name_list])
         dst_db.commit()
+        src_tables: Set[str] = set()
+        if create_flags:
+            assert src_db
+            src_list = [src_tbls[tbl]['dest_table'] for tbl, dest_table in name_list if dest_table not in dst_tables]
+            src_tables, _ = self.probe_tables(src_db.cursor(), src_list)
+            src_db.commit()
 
         self.set_lock_timeout(dst_curs)
 
+        # tables with same trigger args can be registered together
+        reg_map: Dict[Tuple[str, ...], List[Tuple[str, Optional[str], Optional[str]]]] = {}
+        for tbl, dest_table in name_list:
+            reg = self.add_table(src_db, dst_db, tbl, dest_table, create_flags, src_tbls, base_tgargs,
+                                 dst_tables, dst_schemas, src_tables)
+            if reg:
+                tgargs, attrs, dest = reg
+                reg_map.setdefault(tuple(tgargs), []).append((tbl, attrs, dest))
+
+        # actual table registration
+        q = "select r.* from unnest(%s::text[], %s::text[], %s::text[]) t (tbl, attrs, dest),"\
+            " londiste.local_add_table(%s, t.tbl, %s::text[], t.attrs, t.dest) r"
+        try:
+            for tgkey, reg_list in reg_map.items():
+                tbl_list = [reg[0] for reg in reg_list]
+                attrs_list = [reg[1] for reg in reg_list]
+                dest_list = [reg[2] for reg in reg_list]
+                self.exec_cmd(dst_curs, q, [tbl_list, attrs_list, dest_list, self.set_name, list(tgkey)])
+        except BaseException:
+            if len(tables) > 1:
+                self.log.error("Registration failed, rolled back tables: %s", ", ".join(tables))
+            raise
+        dst_db.commit()
+
+    def add_table(self, src_db: Optional[Connection], dst_db: Connection, tbl: str, dest_table: str,
+                  create_flags: int, src_tbls: Dict[str, DictRow], base_tgargs: Sequence[str],
+                  dst_tables: Set[str], dst_schemas: Set[str], src_tables: Set[str],
+                  ) -> Optional[Tuple[List[str], Optional[str], Optional[str]]]:
+        """Create table if requested, return args for local_add_table().
+
+        Existence info comes from probe_tables(), dst_schemas is updated
+        if schema is created.  Returns None if table should be skipped.
+        """
+        dst_curs = dst_db.cursor()
+        tbl_exists = dest_table in dst_tables
+
         if dest_table == tbl:
             desc = tbl
         else:
@@ -257,15 +401,17 @@ class LondisteSetup(CascadeAdmin):
                 self.log.info('Table %s already exist, not touching', desc)
             else:
                 src_dest_table = src_tbls[tbl]['dest_table']
-                if not skytools.exists_table(src_curs, src_dest_table):
+                if src_dest_table not in src_tables:
                     # table not present on provider - nowhere to get the DDL from
                     self.log.warning('Table %s missing on provider, cannot create, skipping', desc)
-                    return
+                    return None
                 schema = skytools.fq_name_parts(dest_table)[0]
-                if not skytools.exists_schema(dst_curs, schema):
+                if schema not in dst_schemas:
                     q = "create schema %s" % skytools.quote_ident(schema)
                     dst_curs.execute(q)
-                s = skytools.TableStruct(src_curs, src_dest_table)
+                    dst_schemas.add(schema)
+                assert src_db
+                s = skytools.TableStruct(src_db.cursor(), src_dest_table)
                 src_db.commit()
 
                 # create, using rename logic only when necessary
@@ -275,9 +421,10 @@ class LondisteSetup(CascadeAdmin):
                 s.create(dst_curs, create_flags, log=self.log, new_table_name=newname)
         elif not tbl_exists and self.options.skip_non_existing:
             self.log.warning('Table %s does not exist on local node, skipping', desc)
-            return
+            return None
 
-        tgargs = self.build_tgargs()
+        # handler may modify the list
+        tgargs = list(base_tgargs)
 
         attrs: Dict[str, str] = {}
 
@@ -296,15 +443,43 @@ class LondisteSetup(CascadeAdmin):
         if self.options.max_parallel_copy:
             attrs['max_parallel_copy'] = self.options.max_parallel_copy
 
-        # actual table registration
-        args = [self.set_name, tbl, tgargs, None, None]
+        s_attrs = None
         if attrs:
-            args[3] = skytools.db_urlencode(attrs)
+            s_attrs = skytools.db_urlencode(attrs)
         if dest_table != tbl:
-            args[4] = dest_table
-        q = "select * from londiste.local_add_table(%s, %s, %s, %s, %s)"
-        self.exec_cmd(dst_curs, q, args)
-        dst_db.commit()
+            return (tgargs, s_attrs, dest_table)
+        return (tgargs, s_attrs, None)
+
+    def probe_tables(self, curs: Cursor, tables: Sequence[str]) -> Tuple[Set[str], Set[str]]:
+        """Check existence of tables and their schemas in one query.
+
+        Returns subsets of given fully-qualified table names and
+        their schema names that exist.
+        """
+        tbl_set: Set[str] = set()
+        schema_set: Set[str] = set()
+        if not tables:
+            return tbl_set, schema_set
+        nsp_list = []
+        rel_list = []
+        for tbl in tables:
+            nsp, rel = skytools.fq_name_parts(tbl)
+            nsp_list.append(nsp)
+            rel_list.append(rel)
+        q = "select t.name, t.nsp,"\
+            "  exists (select 1 from pg_catalog.pg_class c, pg_catalog.pg_namespace n"\
+            "    where c.relnamespace = n.oid and c.relkind = 'r'"\
+            "      and n.nspname = t.nsp and c.relname = t.rel) as tbl_exists,"\
+            "  exists (select 1 from pg_catalog.pg_namespace n"\
+            "    where n.nspname = t.nsp) as schema_exists"\
+            " from unnest(%s::text[], %s::text[], %s::text[]) t (name, nsp, rel)"
+        curs.execute(q, [list(tables), nsp_list, rel_list])
+        for row in curs.fetchall():
+            if row['tbl_exists']:
+                tbl_set.add(row['name'])
+            if row['schema_exists']:
+                schema_set.add(row['nsp'])
+        return tbl_set, schema_set
 
     def build_tgargs(self) -> List[str]:
         """Build trigger args"""
@@ -326,52 +501,94 @@ class LondisteSetup(CascadeAdmin):
 
     def build_handler(self, tbl: str, tgargs: List[str], dest_table: Optional[str] = None) -> str:
         """Build handler and return handler string"""
-        hstr = create_handler_string(self.options.handler, self.options.handler_arg)
+        hstr, _ = self.get_handler_info()
         p = build_handler(tbl, hstr, dest_table)
         p.add(tgargs)
         return hstr
 
     def handler_needs_table(self) -> bool:
         if self.options.handler:
+            _, needs_tbl = self.get_handler_info()
+            return needs_tbl
+        return True
+
+    def get_handler_info(self) -> Tuple[str, bool]:
+        """Return handler string and needs_table() for --handler args.
+
+        Result is cached, as it does not depend on table.
+        """
+        key = (self.options.handler, tuple(self.options.handler_arg or ()))
+        info = self._handler_cache.get(key)
+        if info is None:
             hstr = create_handler_string(self.options.handler, self.options.handler_arg)
             p = build_handler('unused.string', hstr, None)
-            return p.needs_table()
-        return True
+            info = (hstr, p.needs_table())
+            self._handler_cache[key] = info
+        return info
 
     def sync_table_list(self, dst_curs: Cursor, src_tbls: Dict[str, DictRow], dst_tbls: Dict[str, DictRow]) -> None:
-        for tbl in src_tbls.keys():
-            if self.register_only_tables and tbl not in self.register_only_tables:
-                continue
-            if self.register_skip_tables and tbl in self.register_skip_tables:
-                continue
-            q = "select * from londiste.global_add_table(%s, %s)"
-            if tbl not in dst_tbls:
-                self.log.info("Table %s info missing from subscriber, adding", tbl)
-                self.exec_cmd(dst_curs, q, [self.set_name, tbl])
-                dst_tbls[tbl] = cast(DictRow, {'local': False, 'dest_table': tbl})
-        for tbl in list(dst_tbls.keys()):
-            q = "select * from londiste.global_remove_table(%s, %s)"
-            if tbl not in src_tbls:
-                self.log.info("Table %s gone but exists on subscriber, removing", tbl)
-                self.exec_cmd(dst_curs, q, [self.set_name, tbl])
-                del dst_tbls[tbl]
+        add_list = sorted(tbl for tbl in src_tbls.keys() - dst_tbls.keys()
+                          if self.register_table_allowed(tbl))
+        rm_list = sorted(dst_tbls.keys() - src_tbls.keys())
+        for tbl in add_list:
+            self.log.info("Table %s info missing from subscriber, adding", tbl)
+            dst_tbls[tbl] = cast(DictRow, {'local': False, 'dest_table': tbl})
+        for tbl in rm_list:
+            self.log.info("Table %s gone but exists on subscriber, removing", tbl)
+            del dst_tbls[tbl]
+
+        if add_list:
+            q = "select r.* from unnest(%s::text[]) t (tbl), londiste.global_add_table(%s, t.tbl) r"
+            self.exec_cmd(dst_curs, q, [add_list, self.set_name])
+        if rm_list:
+            q = "select r.* from unnest(%s::text[]) t (tbl), londiste.global_remove_table(%s, t.tbl) r"
+            self.exec_cmd(dst_curs, q, [rm_list, self.set_name])
 
     def fetch_set_tables(self, curs: Cursor) -> Dict[str, DictRow]:
         q = "select table_name, local, "\
             " coalesce(dest_table, table_name) as dest_table "\
             " from londiste.get_table_list(%s)"
-        curs.execute(q, [self.set_name])
-        res = {}
-        for row in curs.fetchall():
-            res[row[0]] = row
+        return self.fetch_catalog(curs, q, [self.set_name])
+
+    def fetch_provider_tables(self, src_db: Connection) -> Dict[str, DictRow]:
+        """Fetch table list from provider."""
+        src_curs = src_db.cursor()
+        res = self.fetch_set_tables(src_curs)
+        src_db.commit()
         return res
 
+    def fetch_catalog(self, curs: Cursor, q: str, args: List[Any]) -> Dict[str, DictRow]:
+        """Run catalog query, return rows keyed on first column."""
+        return {row[0]: row for row in self.iter_catalog(curs, q, args)}
+
+    def iter_catalog(self, curs: Cursor, q: str, args: List[Any]) -> Iterator[DictRow]:
+        """Run catalog query, return rows.
+
+        With streaming_catalog_fetch the rows are read via server-side
+        cursor, so huge catalogs are not materialized in one go.
+        """
+        db = cast(Any, curs.connection)
+        if not self.streaming_catalog_fetch or db.autocommit:
+            curs.execute(q, args)
+            yield from curs.fetchall()
+            return
+
+        scurs = db.cursor(name='londiste_catalog')
+        try:
+            scurs.itersize = CATALOG_FETCH_SIZE
+            scurs.execute(q, args)
+            yield from scurs
+        finally:
+            scurs.close()
+
     def cmd_remove_table(self, *tables: str) -> None:
         """Detach table(s) from local node."""
         db = self.get_database('db')
         args = self.expand_arg_list(db, 'r', True, tables)
-        q = "select * from londiste.local_remove_table(%s, %s)"
-        self.exec_cmd_many(db, q, [self.set_name], args)
+        if not args:
+            return
+        q = "select r.* from unnest(%s::text[]) t (tbl), londiste.local_remove_table(%s, t.tbl) r"
+        self.exec_cmd(db, q, [args, self.set_name])
 
     def cmd_change_handler(self, tbl: str) -> None:
         """Change handler (table_attrs) of the replicated table."""
@@ -473,38 +690,39 @@ class LondisteSetup(CascadeAdmin):
 
     def fetch_seqs(self, curs: Cursor) -> Dict[str, DictRow]:
         q = "select seq_name, last_value, local from londiste.get_seq_list(%s)"
-        curs.execute(q, [self.set_name])
-        res = {}
-        for row in curs.fetchall():
-            res[row[0]] = row
-        return res
+        return self.fetch_catalog(curs, q, [self.set_name])
 
     def sync_seq_list(self, dst_curs: Cursor, src_seqs: Dict[str, DictRow], dst_seqs: Dict[str, DictRow]) -> None:
-        for seq in src_seqs.keys():
-            q = "select * from londiste.global_update_seq(%s, %s, %s)"
-            if self.register_only_seqs and seq not in self.register_only_seqs:
-                continue
-            if self.register_skip_seqs and seq in self.register_skip_seqs:
-                continue
-            if seq not in dst_seqs:
-                self.log.info("Sequence %s info missing from subscriber, adding", seq)
-                self.exec_cmd(dst_curs, q, [self.set_name, seq, src_seqs[seq]['last_value']])
-                tmp = dict(src_seqs[seq].items())
-                tmp['local'] = False
-                dst_seqs[seq] = cast(DictRow, tmp)
-        for seq in dst_seqs.keys():
-            q = "select * from londiste.global_remove_seq(%s, %s)"
-            if seq not in src_seqs:
-                self.log.info("Sequence %s gone but exists on subscriber, removing", seq)
-                self.exec_cmd(dst_curs, q, [self.set_name, seq])
-                del dst_seqs[seq]
+        add_list = sorted(seq for seq in src_seqs.keys() - dst_seqs.keys()
+                          if self.register_seq_allowed(seq))
+        rm_list = sorted(dst_seqs.keys() - src_seqs.keys())
+        val_list = []
+        for seq in add_list:
+            self.log.info("Sequence %s info missing from subscriber, adding", seq)
+            val_list.append(src_seqs[seq]['last_value'])
+            tmp = dict(src_seqs[seq].items())
+            tmp['local'] = False
+            dst_seqs[seq] = cast(DictRow, tmp)
+        for seq in rm_list:
+            self.log.info("Sequence %s gone but exists on subscriber, removing", seq)
+            del dst_seqs[seq]
+
+        if add_list:
+            q = "select r.* from unnest(%s::text[], %s::int8[]) s (seq, val),"\
+                " londiste.global_update_seq(%s, s.seq, s.val) r"
+            self.exec_cmd(dst_curs, q, [add_list, val_list, self.set_name])
+        if rm_list:
+            q = "select r.* from unnest(%s::text[]) s (seq), londiste.global_remove_seq(%s, s.seq) r"
+            self.exec_cmd(dst_curs, q, [rm_list, self.set_name])
 
     def cmd_remove_seq(self, *seqs: str) -> None:
         """Detach seqs(s) from local node."""
-        q = "select * from londiste.local_remove_seq(%s, %s)"
         db = self.get_database('db')
         args = self.expand_arg_list(db, 'S', True, seqs)
-        self.exec_cmd_many(db, q, [self.set_name], args)
+        if not args:
+            return
+        q = "select r.* from unnest(%s::text[]) s (seq), londiste.local_remove_seq(%s, s.seq) r"
+        self.exec_cmd(db, q, [args, self.set_name])
 
     def cmd_resync(self, *tables: str) -> None:
         """Reload data from provider node."""
@@ -514,9 +732,7 @@ class LondisteSetup(CascadeAdmin):
         if not self.options.find_copy_node:
             self.load_local_info()
             src_db = self.get_provider_db()
-            src_curs = src_db.cursor()
-            src_tbls = self.fetch_set_tables(src_curs)
-            src_db.commit()
+            src_tbls = self.fetch_provider_tables(src_db)
 
             problems = 0
             for tbl in args:
@@ -528,26 +744,28 @@ class LondisteSetup(CascadeAdmin):
                 self.log.error("Problems, cancelling operation")
                 sys.exit(1)
 
-        if self.options.find_copy_node or self.options.copy_node:
-            q = "select table_name, table_attrs from londiste.get_table_list(%s) where local"
-            cur = db.cursor()
-            cur.execute(q, [self.set_name])
-            for row in cur.fetchall():
-                if row['table_name'] not in args:
-                    continue
-                attrs = skytools.db_urldecode(row['table_attrs'] or '')
-
-                if self.options.find_copy_node:
-                    attrs['copy_node'] = '?'
-                elif self.options.copy_node:
-                    attrs['copy_node'] = self.options.copy_node
-
-                s_attrs = skytools.db_urlencode(attrs)
-                q = "select * from londiste.local_set_table_attrs(%s, %s, %s)"
-                self.exec_cmd(db, q, [self.set_name, row['table_name'], s_attrs])
-
-        q = "select * from londiste.local_set_table_state(%s, %s, null, null)"
-        self.exec_cmd_many(db, q, [self.set_name], args)
+        if args and (self.options.find_copy_node or self.options.copy_node):
+            if self.options.find_copy_node:
+                copy_node = '?'
+            else:
+                copy_node = self.options.copy_node
+
+            # replace copy_node in urlencoded table_attrs on server side
+            q = "select r.* from ("\
+                "   select t.table_name, array_to_string(array("\
+                "       select kv from unnest(string_to_array(t.table_attrs, '&')) kv"\
+                "        where kv <> '' and split_part(kv, '=', 1) <> 'copy_node'"\
+                "     ) || %s::text, '&') as table_attrs"\
+                "   from londiste.get_table_list(%s) t"\
+                "   where t.local and t.table_name = any(%s::text[])"\
+                " ) a, londiste.local_set_table_attrs(%s, a.table_name, a.table_attrs) r"
+            s_attr = skytools.db_urlencode({'copy_node': copy_node})
+            self.exec_cmd(db, q, [s_attr, self.set_name, args, self.set_name])
+
+        if args:
+            q = "select r.* from unnest(%s::text[]) t (tbl),"\
+                " londiste.local_set_table_state(%s, t.tbl, null, null) r"
+            self.exec_cmd(db, q, [args, self.set_name])
 
     def cmd_tables(self) -> None:
         """Show attached tables."""
@@ -563,13 +781,9 @@ class LondisteSetup(CascadeAdmin):
             from londiste.get_table_list(%s) where local
             order by table_name"""
             curs = db.cursor()
-            curs.execute(sql, [self.set_name])
-            rows = curs.fetchall()
-            db.commit()
-            if len(rows) == 0:
-                return
-            for row in rows:
+            for row in self.iter_catalog(curs, sql, [self.set_name]):
                 print(row['table_name'])
+            db.commit()
         else:
             q = """select table_name, merge_state, table_attrs
             from londiste.get_table_list(%s) where local
@@ -613,14 +827,8 @@ class LondisteSetup(CascadeAdmin):
         seqs = self.fetch_seqs(curs)
 
         # generate local maps
-        local_tables = {}
-        local_seqs = {}
-        for tbl in tables.values():
-            if tbl['local']:
-                local_tables[tbl['table_name']] = tbl['dest_table']
-        for seq in seqs.values():
-            if seq['local']:
-                local_seqs[seq['seq_name']] = seq['seq_name']
+        local_tables = {tbl['table_name']: tbl['dest_table'] for tbl in tables.values() if tbl['local']}
+        local_seqs = {seq['seq_name']: seq['seq_name'] for seq in seqs.values() if seq['local']}
 
         # set replica role for EXECUTE transaction
         curs.execute("select londiste.set_session_replication_role('local', true)")
@@ -671,26 +879,27 @@ class LondisteSetup(CascadeAdmin):
         curs = db.cursor()
 
         if kind == 'S':
-            q1 = "select seq_name, local from londiste.get_seq_list(%s) where local"
+            q1 = "select seq_name, true from londiste.get_seq_list(%s) where local"
         elif kind == 'r':
-            q1 = "select table_name, local from londiste.get_table_list(%s) where local"
+            q1 = "select table_name, true from londiste.get_table_list(%s) where local"
         else:
             raise Exception("bug")
-        q2 = "select obj_name from londiste.local_show_missing(%%s) where obj_kind = '%s'" % kind
+        q2 = "select obj_name, false from londiste.local_show_missing(%%s) where obj_kind = '%s'" % kind
 
+        # both lists in one round-trip, second column tells which one
         lst_exists: List[str] = []
-        map_exists: Dict[str, int] = {}
-        curs.execute(q1, [self.set_name])
-        for row in curs.fetchall():
-            lst_exists.append(row[0])
-            map_exists[row[0]] = 1
-
+        set_exists: Set[str] = set()
         lst_missing: List[str] = []
-        map_missing: Dict[str, int] = {}
-        curs.execute(q2, [self.set_name])
+        set_missing: Set[str] = set()
+        curs.execute(q1 + " union all " + q2, [self.set_name, self.set_name])
         for row in curs.fetchall():
-            lst_missing.append(row[0])
-            map_missing[row[0]] = 1
+            name = row[0]
+            if row[1]:
+                lst_exists.append(name)
+                set_exists.add(name)
+            else:
+                lst_missing.append(name)
+                set_missing.add(name)
 
         db.commit()
 
@@ -702,50 +911,79 @@ class LondisteSetup(CascadeAdmin):
 
         allow_nonexist = not needs_tbl
         if existing:
-            res = self.solve_globbing(args, lst_exists, map_exists, map_missing, allow_nonexist)
+            res = self.solve_globbing(args, lst_exists, set_exists, set_missing, allow_nonexist)
         else:
-            res = self.solve_globbing(args, lst_missing, map_missing, map_exists, allow_nonexist)
+            res = self.solve_globbing(args, lst_missing, set_missing, set_exists, allow_nonexist)
 
         if not res:
             self.log.info("what to do ?")
         return res
 
     def solve_globbing(self, args: Sequence[str], full_list: Sequence[str],
-                       full_map: Dict[str, int], reverse_map: Dict[str, int],
+                       full_map: Set[str], reverse_map: Set[str],
                        allow_nonexist: bool) -> List[str]:
+        """Expand wildcard args against full_list, check plain ones.
+
+        Only '*' and '?' are wildcards, '[' is literal.  Result is
+        in argument order, matches of one pattern in full_list order:
+
+        >>> s = LondisteSetup.__new__(LondisteSetup)
+        >>> tables = ['public.a1', 'public.b1', 'public.a[2]', 'other.a3']
+        >>> s.solve_globbing(['a?', 'a[?]', 'other.*'], tables, set(tables), set(), False)
+        ['public.a1', 'public.a[2]', 'other.a3']
+        >>> s.solve_globbing(['other.*', 'b1', '*'], tables, set(tables), set(), False)
+        ['other.a3', 'public.b1', 'public.a1', 'public.a[2]']
+        """
         def glob2regex(s: str) -> str:
-            s = s.replace('.', '[.]').replace('?', '.').replace('*', '.*')
-            return '^%s$' % s
+            # only * and ? are special, keep [ literal
+            return fnmatch.translate(s.replace('[', '[[]'))
 
-        res_map = {}
-        res_list = []
-        err = 0
+        # all wildcard args are matched with single regex, in one pass,
+        # other args are normalized once
+        wild_list: List[str] = []
+        arg_list: List[Tuple[int, str]] = []
         for a in args:
-            if a.find('*') >= 0 or a.find('?') >= 0:
-                if a.find('.') < 0:
+            if '*' in a or '?' in a:
+                if '.' not in a:
                     a = 'public.' + a
-                rc = re.compile(glob2regex(a))
-                for x in full_list:
-                    if rc.match(x):
-                        if x not in res_map:
-                            res_map[x] = 1
-                            res_list.append(x)
+                arg_list.append((len(wild_list), a))
+                wild_list.append('(?P<p%d>%s)' % (len(wild_list), glob2regex(a)))
+            else:
+                arg_list.append((-1, skytools.fq_name(a)))
+
+        # matches by pattern, alternation gives first pattern that matches
+        wild_matches: List[List[str]] = [[] for _ in wild_list]
+        if wild_list:
+            rc = re.compile('|'.join(wild_list))
+            for x in full_list:
+                m = rc.fullmatch(x)
+                if m and m.lastgroup:
+                    wild_matches[int(m.lastgroup[1:])].append(x)
+
+        res_set: Set[str] = set()
+        res_list = []
+        err = 0
+        for wild_idx, a in arg_list:
+            if wild_idx >= 0:
+                for x in wild_matches[wild_idx]:
+                    if x not in res_set:
+                        res_set.add(x)
+                        res_list.append(x)
             else:
-                a = skytools.fq_name(a)
-                if a in res_map:
+                if a in res_set:
                     continue
                 elif a in full_map:
                     res_list.append(a)
-                    res_map[a] = 1
+                    res_set.add(a)
                 elif a in reverse_map:
                     self.log.info("%s already processed", a)
                 elif allow_nonexist:
                     res_list.append(a)
-                    res_map[a] = 1
+                    res_set.add(a)
                 elif self.options.force:
                     self.log.warning("%s not available, but --force is used", a)
                     res_list.append(a)
-                    res_map[a] = 1
+                    res_set.add(a)
                 else:
                     self.log.warning("%s not available", a)
                     err = 1
@@ -757,16 +995,13 @@ class LondisteSetup(CascadeAdmin):
         """Fetch extra info."""
         # must be thread-safe (!)
         super().load_extra_status(curs, node)
-        curs.execute("select * from londiste.get_table_list(%s)", [self.queue_name])
-        n_ok = n_half = n_ign = 0
-        for tbl in curs.fetchall():
-            if not tbl['local']:
-                n_ign += 1
-            elif tbl['merge_state'] == 'ok':
-                n_ok += 1
-            else:
-                n_half += 1
-        node.add_info_line('Tables: %d/%d/%d' % (n_ok, n_half, n_ign))
+        q = "select count(*) filter (where local and merge_state = 'ok') as n_ok,"\
+            " count(*) filter (where local and merge_state is distinct from 'ok') as n_half,"\
+            " count(*) filter (where not local) as n_ign"\
+            " from londiste.get_table_list(%s)"
+        curs.execute(q, [self.queue_name])
+        row = curs.fetchone()
+        node.add_info_line('Tables: %d/%d/%d' % (row['n_ok'], row['n_half'], row['n_ign']))
 
     def cmd_wait_sync(self) -> None:
         self.load_local_info()
@@ -776,46 +1011,38 @@ class LondisteSetup(CascadeAdmin):
 
     def wait_for_sync(self, dst_db: Connection) -> None:
         self.log.info("Waiting until all tables are in sync")
-        q = "select table_name, merge_state, local"\
+        q = "select table_name, merge_state"\
             " from londiste.get_table_list(%s) where local"
         dst_curs = dst_db.cursor()
+        dst_curs.execute(q, [self.queue_name])
+        rows = dst_curs.fetchall()
+        dst_db.commit()
+
+        total_count = len(rows)
+        pending = {row['table_name'] for row in rows if row['merge_state'] != 'ok'}
+        self.log.info("%d/%d table(s) to copy", len(pending), total_count)
+
+        # poll only tables still copying, dropped tables disappear from result
+        q = "select table_name, merge_state"\
+            " from londiste.get_table_list(%s) where local and table_name = any(%s)"
+        interval = self.wait_sync_min
+        while pending:
+            self.sleep(interval)
 
-        partial = {}
-        startup_info = 0
-        while True:
-            dst_curs.execute(q, [self.queue_name])
+            dst_curs.execute(q, [self.queue_name, sorted(pending)])
             rows = dst_curs.fetchall()
             dst_db.commit()
 
-            total_count = 0
-            cur_count = 0
-            done_list = []
-            for row in rows:
-                if not row['local']:
-                    continue
-                total_count += 1
-                tbl = row['table_name']
-                if row['merge_state'] != 'ok':
-                    partial[tbl] = 0
-                    cur_count += 1
-                elif tbl in partial:
-                    if partial[tbl] == 0:
-                        partial[tbl] = 1
-                        done_list.append(tbl)
-
-            done_count = total_count - cur_count
-
-            if not startup_info:
-                self.log.info("%d/%d table(s) to copy", cur_count, total_count)
-                startup_info = 1
-
+            pending = {row['table_name'] for row in rows if row['merge_state'] != 'ok'}
+            done_list = [row['table_name'] for row in rows if row['merge_state'] == 'ok']
+            done_count = total_count - len(pending)
             for done in done_list:
                 self.log.info("%s: finished (%d/%d)", done, done_count, total_count)
 
-            if cur_count == 0:
-                break
-
-            self.sleep(2)
+            if done_list:
+                interval = self.wait_sync_min
+            else:
+                interval = min(interval * 2, self.wait_sync_max)
 
         self.log.info("All done")
 
@@ -827,29 +1054,23 @@ class LondisteSetup(CascadeAdmin):
         ROLLBACK = 'can rollback'
         NO_ROLLBACK = 'cannot rollback'
 
-        if ev['ev_type'] == 'TRUNCATE':
-            if 'truncated_tables' not in stats:
-                stats['truncated_tables'] = []
-            tlist = stats['truncated_tables']
-            tbl = ev['ev_extra1']
-            if tbl not in tlist:
-                tlist.append(tbl)
-        elif ev['ev_type'][:2] in ('I:', 'U:', 'D:', 'I', 'U', 'D'):
-            op = ev['ev_type'][0]
-            tbl = ev['ev_extra1']
-            bak = ev['ev_extra3']
-            tblkey = 'table: %s' % tbl
-            if tblkey not in stats:
-                stats[tblkey] = [0, 0, 0, ROLLBACK]
-            tinfo = stats[tblkey]
-            if op == 'I':
-                tinfo[0] += 1
-            elif op == 'U':
-                tinfo[1] += 1
-                if not bak:
-                    tinfo[3] = NO_ROLLBACK
-            elif op == 'D':
-                tinfo[2] += 1
-                if not bak and ev['ev_type'] == 'D':
-                    tinfo[3] = NO_ROLLBACK
+        ev_type = ev['ev_type']
+        if ev_type == 'TRUNCATE':
+            # set lives in stats, so it is scoped to current run
+            stats.setdefault('truncated_tables', set()).add(ev['ev_extra1'])
+            return
+
+        pos = _EV_OP_TABLE.get(ev_type[:1])
+        if pos is None or ev_type[1:2] not in ('', ':'):
+            return
+
+        tblkey = 'table: %s' % ev['ev_extra1']
+        tinfo = stats.get(tblkey)
+        if tinfo is None:
+            tinfo = stats[tblkey] = [0, 0, 0, ROLLBACK]
+        tinfo[pos] += 1
+
+        # U without backup, or old-style D without backup
+        if not ev['ev_extra3'] and (pos == 1 or ev_type == 'D'):
+            tinfo[3] = NO_ROLLBACK
 
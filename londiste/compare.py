@@ -3,13 +3,13 @@
 Currently just does count(1) on both sides.
 """
 
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import sys
 import optparse
 
 import skytools
-from skytools.basetypes import Cursor, Connection
+from skytools.basetypes import Cursor, Connection, DictRow
 
 from londiste.syncer import Syncer, ATable
 
@@ -20,6 +20,16 @@ class Comparator(Syncer):
     """Simple checker based on Syncer.
     When tables are in sync runs simple SQL query on them.
     """
+
+    _cols_cache: Dict[Tuple[str, str], str]
+
+    def __init__(self, args: Sequence[str]) -> None:
+        super().__init__(args)
+        self._cols_cache = {}
+
+        # run provider and subscriber queries concurrently
+        self.compare_pipeline = self.cf.getboolean('compare_pipeline', False)
+
     def process_sync(self, t1: ATable, t2: ATable, src_db: Connection, dst_db: Connection) -> int:
         """Actual comparison."""
 
@@ -35,48 +45,81 @@ class Comparator(Syncer):
         self.log.info('Counting %s', dst_tbl)
 
         # get common cols
-        cols = self.calc_cols(src_curs, src_tbl, dst_curs, dst_tbl)
+        cols_key = (src_tbl, dst_tbl)
+        cols = self._cols_cache.get(cols_key)
+        if cols is None:
+            cols = self.calc_cols(src_curs, src_tbl, dst_curs, dst_tbl)
+            self._cols_cache[cols_key] = cols
+
+        # cheap count before full checksum, mismatch stops early
+        if self.options.count_first and not self.options.count_only:
+            q = "select count(1) as cnt from only _TABLE_"
+            src_row, dst_row = self.run_compare(q, src_db, src_tbl, src_where, dst_db, dst_tbl, dst_where)
+            if src_row['cnt'] != dst_row['cnt']:
+                self.log.info("srcdb: %d rows", src_row['cnt'])
+                self.log.info("dstdb: %d rows", dst_row['cnt'])
+                self.log.warning("%s: Results do not match!", dst_tbl)
+                return 1
 
         # get sane query
         if self.options.count_only:
             q = "select count(1) as cnt from only _TABLE_"
         else:
             # this way is much faster than the above
-            q = "select count(1) as cnt, sum(hashtext(_COLS_::text)::bigint) as chksum from only _TABLE_"
+            # compare_hash_sql allows faster hash, eg. xxhash64(_COLS_::text) from pg_xxhash
+            hash_sql = self.cf.get('compare_hash_sql', 'hashtext(_COLS_::text)')
+            q = "select count(1) as cnt, sum((%s)::bigint) as chksum from only _TABLE_" % hash_sql
 
         q = self.cf.get('compare_sql', q)
         q = q.replace("_COLS_", cols)
-        src_q = q.replace('_TABLE_', skytools.quote_fqident(src_tbl))
-        if src_where:
-            src_q = src_q + " WHERE " + src_where
-        dst_q = q.replace('_TABLE_', skytools.quote_fqident(dst_tbl))
-        if dst_where:
-            dst_q = dst_q + " WHERE " + dst_where
 
         f = "%(cnt)d rows"
         if not self.options.count_only:
             f += ", checksum=%(chksum)s"
         f = self.cf.get('compare_fmt', f)
 
-        self.log.debug("srcdb: %s", src_q)
-        src_curs.execute(src_q)
-        src_row = src_curs.fetchone()
+        src_row, dst_row = self.run_compare(q, src_db, src_tbl, src_where, dst_db, dst_tbl, dst_where)
         src_str = f % src_row
         self.log.info("srcdb: %s", src_str)
-        src_db.commit()
-
-        self.log.debug("dstdb: %s", dst_q)
-        dst_curs.execute(dst_q)
-        dst_row = dst_curs.fetchone()
         dst_str = f % dst_row
         self.log.info("dstdb: %s", dst_str)
-        dst_db.commit()
 
         if src_str != dst_str:
             self.log.warning("%s: Results do not match!", dst_tbl)
             return 1
         return 0
 
+    def run_compare(self, q: str,
+                    src_db: Connection, src_tbl: str, src_where: Optional[str],
+                    dst_db: Connection, dst_tbl: str, dst_where: Optional[str]) -> Tuple[DictRow, DictRow]:
+        """Run compare query on both sides, return result rows."""
+        src_q = q.replace('_TABLE_', skytools.quote_fqident(src_tbl))
+        if src_where:
+            src_q = src_q + " WHERE " + src_where
+        dst_q = q.replace('_TABLE_', skytools.quote_fqident(dst_tbl))
+        if dst_where:
+            dst_q = dst_q + " WHERE " + dst_where
+
+        def run_query(side: str, db: Connection, sql: str) -> DictRow:
+            curs = db.cursor()
+            self.log.debug("%s: %s", side, sql)
+            curs.execute(sql)
+            row = curs.fetchone()
+            db.commit()
+            return row
+
+        if not self.compare_pipeline:
+            src_row = run_query("srcdb", src_db, src_q)
+            dst_row = run_query("dstdb", dst_db, dst_q)
+            return src_row, dst_row
+
+        import concurrent.futures
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            src_f = executor.submit(run_query, "srcdb", src_db, src_q)
+            dst_f = executor.submit(run_query, "dstdb", dst_db, dst_q)
+            return src_f.result(), dst_f.result()
+
     def calc_cols(self, src_curs: Cursor, src_tbl: str, dst_curs: Cursor, dst_tbl: str) -> str:
         cols1 = self.load_cols(src_curs, src_tbl)
         cols2 = self.load_cols(dst_curs, dst_tbl)
@@ -89,21 +132,14 @@ class Comparator(Syncer):
     def load_cols(self, curs: Cursor, tbl: str) -> List[str]:
         schema, table = skytools.fq_name_parts(tbl)
         q = "select column_name from information_schema.columns"\
-            " where table_schema = %s and table_name = %s"
+            " where table_schema = %s and table_name = %s"\
+            " order by ordinal_position"
         curs.execute(q, [schema, table])
-        cols = []
-        for row in curs.fetchall():
-            cols.append(row[0])
-        return cols
+        return [row[0] for row in curs.fetchall()]
 
     def calc_common(self, cols1: List[str], cols2: List[str]) -> List[str]:
-        common = []
-        map2: Dict[str, int] = {}
-        for c in cols2:
-            map2[c] = 1
-        for c in cols1:
-            if c in map2:
-                common.append(c)
+        set2 = set(cols2)
+        common = [c for c in cols1 if c in set2]
         if len(common) == 0:
             raise Exception("no common columns found")
 
@@ -116,6 +152,8 @@ class Comparator(Syncer):
         """Initialize cmdline switches."""
         p = super().init_optparse(p)
         p.add_option("--count-only", action="store_true", help="just count rows, do not compare data")
+        p.add_option("--count-first", action="store_true",
+                     help="compare row counts before checksum, skip checksum on mismatch")
         return p
 
 
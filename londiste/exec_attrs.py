@@ -50,6 +50,9 @@ True
 --*-- Local-Destination: mytable-longname-more1, mytable-longname-more2,
 --*--     mytable-longname-more3, mytable-longname-more4, mytable-longname-more5,
 --*--     mytable-longname-more6, mytable-longname-more7
+>>> b = ExecAttrs(sql = a.to_sql() + "\\ncreate table x;")
+>>> b.to_sql() == a.to_sql()
+True
 >>> a = ExecAttrs(sql = '''
 ...
 ...  --
@@ -69,6 +72,12 @@ True
 >>> print(a.to_sql())
 --*-- Local-Table: foo, bar, zoo
 --*-- Local-Sequence: goo
+>>> print(ExecAttrs(sql = '''
+...   --*-- Local-Table: t1
+...   select 1;
+... --*-- Local-Table: t2
+... ''').to_sql())
+--*-- Local-Table: t1
 >>> seqs = {'public.goo': 'public.goo'}
 >>> tables = {}
 >>> tables['public.foo'] = 'public.foo'
@@ -87,20 +96,74 @@ alter table other."Bar";
 alter table "Other"."Foo";
 """
 
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+import re
+import types
 
 import skytools
 from skytools.basetypes import Cursor
 
 META_PREFIX = "--*--"
 
+# first line that is not empty and not a comment
+_STOP_RE = re.compile(r"^[^\S\n]*(?!--)\S", re.M)
+
+# meta-comment line, captures text after prefix
+_META_RE = re.compile(r"^[^\S\n]*%s(.*)$" % re.escape(META_PREFIX), re.M)
+
+
+# catalog probe: (kind, name, nargs), kind is relkind or 'schema'/'function'
+Probe = Tuple[str, str, int]
+
+# checks all probes in one round-trip, same rules as skytools.exists_*
+_PROBE_SQL = """
+select t.kind, t.name, t.nargs
+  from unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::int4[]) t (kind, name, nsp, rel, nargs)
+ where case t.kind
+         when 'schema' then exists (
+            select 1 from pg_namespace n
+             where n.nspname = t.name)
+         when 'function' then exists (
+            select 1 from pg_namespace n, pg_proc p
+             where p.pronamespace = n.oid and p.pronargs = t.nargs
+               and n.nspname = t.nsp and p.proname = t.rel)
+         else exists (
+            select 1 from pg_namespace n, pg_class c
+             where c.relnamespace = n.oid and c.relkind::text = t.kind
+               and n.nspname = t.nsp and c.relname = t.rel)
+       end
+"""
+
+
+def probe_catalog(curs: Cursor, probes: Sequence[Probe]) -> Set[Probe]:
+    """Return probes that exist in database."""
+    parts = [skytools.fq_name_parts(p[1]) for p in probes]
+    args = [
+        [p[0] for p in probes], [p[1] for p in probes],
+        [nsp for nsp, _ in parts], [rel for _, rel in parts],
+        [p[2] for p in probes],
+    ]
+    curs.execute(_PROBE_SQL, args)
+    return {(row[0], row[1], row[2]) for row in curs.fetchall()}
+
 
 class Matcher:
     nice_name: str = ''
+    key: str = ''
+    def __init_subclass__(cls) -> None:
+        super().__init_subclass__()
+        cls.key = cls.nice_name.lower()
     def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
+        probe = self.probe(objname, tables, seqs)
+        if probe:
+            return bool(probe_catalog(curs, [probe]))
         return False
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
+        """Catalog lookup needed for match, None if decided locally."""
+        return None
     def get_key(self) -> str:
-        return self.nice_name.lower()
+        return self.key
     def local_rename(self) -> bool:
         return False
 
@@ -123,36 +186,35 @@ class LocalSequence(Matcher):
 
 class LocalDestination(Matcher):
     nice_name = "Local-Destination"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
         if objname not in tables:
-            return False
-        dest_name = tables[objname]
-        return skytools.exists_table(curs, dest_name)
+            return None
+        return ('r', tables[objname], 0)
     def local_rename(self) -> bool:
         return True
 
 
 class NeedTable(Matcher):
     nice_name = "Need-Table"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
-        return skytools.exists_table(curs, objname)
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
+        return ('r', objname, 0)
 
 
 class NeedSequence(Matcher):
     nice_name = "Need-Sequence"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
-        return skytools.exists_sequence(curs, objname)
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
+        return ('S', objname, 0)
 
 
 class NeedSchema(Matcher):
     nice_name = "Need-Schema"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
-        return skytools.exists_schema(curs, objname)
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
+        return ('schema', objname, 0)
 
 
 class NeedFunction(Matcher):
     nice_name = "Need-Function"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
         nargs = 0
         pos1 = objname.find('(')
         if pos1 > 0:
@@ -161,13 +223,13 @@ class NeedFunction(Matcher):
                 s = objname[pos1 + 1: pos2]
                 objname = objname[:pos1]
                 nargs = int(s)
-        return skytools.exists_function(curs, objname, nargs)
+        return ('function', objname, nargs)
 
 
 class NeedView(Matcher):
     nice_name = "Need-View"
-    def match(self, objname: str, curs: Cursor,  tables: Dict[str, str],  seqs: Dict[str, str]) -> bool:
-        return skytools.exists_view(curs, objname)
+    def probe(self, objname: str, tables: Dict[str, str], seqs: Dict[str, str]) -> Optional[Probe]:
+        return ('v', objname, 0)
 
 
 META_SPLITLINE = 70
@@ -180,7 +242,7 @@ META_MATCHERS = [
 ]
 
 # key to nice key
-META_KEYS = {m.nice_name.lower(): m for m in META_MATCHERS}
+META_KEYS = types.MappingProxyType({m.key: m for m in META_MATCHERS})
 
 
 class ExecAttrsException(skytools.UsageError):
@@ -190,11 +252,13 @@ class ExecAttrsException(skytools.UsageError):
 class ExecAttrs:
     """Container and parser for EXECUTE attributes."""
     attrs: Dict[str, List[str]]
+    _fqname_cache: Dict[str, str]
 
     def __init__(self, sql: Optional[str] = None, urlenc: Optional[str] = None) -> None:
         """Create container and parse either sql or urlenc string."""
 
         self.attrs = {}
+        self._fqname_cache = {}
         if sql and urlenc:
             raise Exception("Both sql and urlenc set.")
         if urlenc:
@@ -233,48 +297,42 @@ class ExecAttrs:
         """Convert container to SQL meta-comments."""
         lines = []
         for m in META_MATCHERS:
-            k = m.get_key()
+            k = m.key
             if k not in self.attrs:
                 continue
             vlist = self.attrs[k]
-            ln = "%s %s: " % (META_PREFIX, m.nice_name)
-            start = 0
+            last = len(vlist) - 1
+            head = "%s %s: " % (META_PREFIX, m.nice_name)
+            cur: List[str] = []
+            curlen = len(head)
             for nr, v in enumerate(vlist):
-                if nr > start:
-                    ln = ln + ", " + v
-                else:
-                    ln = ln + v
-
-                if len(ln) >= META_SPLITLINE and nr < len(vlist) - 1:
-                    ln += ','
-                    lines.append(ln)
-                    ln = META_PREFIX + "     "
-                    start = nr + 1
-            lines.append(ln)
+                if cur:
+                    curlen += 2
+                cur.append(v)
+                curlen += len(v)
+
+                if curlen >= META_SPLITLINE and nr < last:
+                    lines.append(head + ", ".join(cur) + ',')
+                    head = META_PREFIX + "     "
+                    cur = []
+                    curlen = len(head)
+            lines.append(head + ", ".join(cur))
         return '\n'.join(lines)
 
     def parse_sql(self, sql: str) -> None:
         """Parse SQL meta-comments."""
 
+        # stop at non-comment
+        m = _STOP_RE.search(sql)
+        if m:
+            sql = sql[:m.start()]
+
         cur_key: Optional[str] = None
         cur_continued = False
-        for ln in sql.splitlines():
+        for m in _META_RE.finditer(sql):
 
-            # skip empty lines
-            ln = ln.strip()
-            if not ln:
-                continue
-
-            # stop at non-comment
-            if ln[:2] != '--':
-                break
-
-            # parse only meta-comments
-            if ln[:len(META_PREFIX)] != META_PREFIX:
-                continue
-
-            # cut prefix, skip empty comments
-            ln = ln[len(META_PREFIX):].strip()
+            # skip empty comments
+            ln = m.group(1).strip()
             if not ln:
                 continue
 
@@ -287,7 +345,7 @@ class ExecAttrs:
                         self.add_value(cur_key, v)
 
                 # does this key continue?
-                if ln[-1] != ',':
+                if not ln.endswith(','):
                     cur_key = None
                     cur_continued = False
 
@@ -295,20 +353,20 @@ class ExecAttrs:
                 continue
 
             # parse key
-            pos = ln.find(':')
-            if pos < 0:
+            k, sep, vals = ln.partition(':')
+            if not sep:
                 continue
-            k = ln[:pos].strip()
+            k = k.strip()
 
             # collect values
-            for v in ln[pos + 1:].split(','):
+            for v in vals.split(','):
                 v = v.strip()
                 if not v:
                     continue
                 self.add_value(k, v)
 
             # check if current key values will continue
-            if ln[-1] == ',':
+            if ln.endswith(','):
                 cur_key = k
                 cur_continued = True
             else:
@@ -324,19 +382,35 @@ class ExecAttrs:
         missed = 0
         good_list = []
         miss_list = []
+
+        checks: List[Tuple[Matcher, str, str, Optional[Probe]]] = []
         for m in META_MATCHERS:
-            k = m.get_key()
-            if k not in self.attrs:
-                continue
-            for v in self.attrs[k]:
-                fqname = skytools.fq_name(v)
-                if m.match(fqname, curs, local_tables, local_seqs):
-                    matched += 1
-                    good_list.append(v)
-                else:
-                    missed += 1
-                    miss_list.append(v)
-                    # should be drop out early?
+            for v in self.attrs.get(m.key, []):
+                fqname = self._fq_name(v)
+                checks.append((m, v, fqname, m.probe(fqname, local_tables, local_seqs)))
+
+        def results() -> Iterator[Tuple[str, bool]]:
+            # local checks first, catalog lookups run in one query
+            for m, v, fqname, probe in checks:
+                if not probe:
+                    yield v, m.match(fqname, curs, local_tables, local_seqs)
+            probes = list(dict.fromkeys(p for _, _, _, p in checks if p))
+            if probes:
+                found = probe_catalog(curs, probes)
+                for _, v, _, probe in checks:
+                    if probe:
+                        yield v, probe in found
+
+        for v, ok in results():
+            if ok:
+                matched += 1
+                good_list.append(v)
+            else:
+                missed += 1
+                miss_list.append(v)
+            # partial match is error, no need to look further
+            if matched and missed:
+                break
         if matched > 0 and missed == 0:
             return True
         elif missed > 0 and matched == 0:
@@ -347,6 +421,13 @@ class ExecAttrs:
         else:
             raise Exception("SQL only partially matches local setup: matches=%r misses=%r" % (good_list, miss_list))
 
+    def _fq_name(self, v: str) -> str:
+        """Cached skytools.fq_name()."""
+        fqname = self._fqname_cache.get(v)
+        if fqname is None:
+            fqname = self._fqname_cache[v] = skytools.fq_name(v)
+        return fqname
+
     def get_attr(self, k: str) -> List[str]:
         k = k.lower().strip()
         if k not in META_KEYS:
@@ -357,13 +438,14 @@ class ExecAttrs:
 
     def process_sql(self, sql: str, local_tables: Dict[str, str], local_seqs: Dict[str, str]) -> str:
         """Replace replacement tags in sql with actual local names."""
+        mapping: Dict[str, str] = {}
         for k, vlist in self.attrs.items():
             m = META_KEYS[k]
             if not m.local_rename():
                 continue
             for v in vlist:
                 repname = '@%s@' % v
-                fqname = skytools.fq_name(v)
+                fqname = self._fq_name(v)
                 if fqname in local_tables:
                     localname = local_tables[fqname]
                 elif fqname in local_seqs:
@@ -371,7 +453,9 @@ class ExecAttrs:
                 else:
                     # should not happen
                     raise Exception("bug: lost table: " + v)
-                qdest = skytools.quote_fqident(localname)
-                sql = sql.replace(repname, qdest)
-        return sql
+                mapping[repname] = skytools.quote_fqident(localname)
+        if not mapping:
+            return sql
+        rc = re.compile('|'.join(re.escape(repname) for repname in mapping))
+        return rc.sub(lambda m: mapping[m.group(0)], sql)
 
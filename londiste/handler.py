@@ -4,10 +4,13 @@
 Per-table decision how to create trigger, copy data and apply events.
 """
 
-from typing import List, Dict, Any, Sequence, Tuple, Optional, Union, Callable, Type
+from typing import List, Dict, Any, Sequence, Tuple, Optional, Union, Callable, Type, FrozenSet, ClassVar
 
+import functools
+import io
 import json
 import logging
+import re
 import sys
 
 import skytools
@@ -19,9 +22,33 @@ from pgq.baseconsumer import BatchInfo
 
 import londiste.util
 
+try:
+    import orjson
+    HAVE_ORJSON = True
+    # older orjson turns big integers into float, that would lose data
+    try:
+        HAVE_ORJSON = isinstance(orjson.loads('18446744073709551616'), int)
+    except orjson.JSONDecodeError:
+        pass
+except ImportError:
+    HAVE_ORJSON = False
+
 ApplyFunc = Callable[[str, Cursor], None]
 
 
+def json_loads(data: str) -> Any:
+    """Decode event json, with orjson when available.
+
+    Input orjson refuses (eg. integers over 64 bits, NaN) goes to stdlib json.
+    """
+    if HAVE_ORJSON:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(data)
+
+
 _ = """
 
 -- redirect & create table
@@ -53,37 +80,118 @@ __all__ = ['RowCache', 'BaseHandler', 'build_handler',
            'Event', 'Cursor', 'Connection']
 
 
+# sql templates for row events, same shape as skytools.mk_*_sql()
+_ROW_SQL_COMMAND = {
+    'I': "insert into %s (%s) values (%s);",
+    'U': "update only %s set %s where %s;",
+    'D': "delete from only %s where %s;",
+}
+
+
+def row_sql_template(op: str, qtable: str, pkeys: Sequence[str], fields: Sequence[str]) -> Tuple[str, Tuple[str, ...]]:
+    """Return format string for row event and order of values for it.
+
+    Values must be quoted with skytools.quote_literal().
+
+    >>> row_sql_template('I', 'public.t', ['id'], ['id', 'val'])
+    ('insert into public.t (id, val) values (%s, %s);', ('id', 'val'))
+    >>> row_sql_template('U', 'public.t', ['id'], ['id', 'val', 'x%y'])
+    ('update only public.t set val = %s, "x%%y" = %s where id = %s;', ('val', 'x%y', 'id'))
+    >>> row_sql_template('D', 'public.t', ['a', 'b'], ['a', 'b', 'val'])
+    ('delete from only public.t where a = %s and b = %s;', ('a', 'b'))
+    """
+    cmd = _ROW_SQL_COMMAND[op]
+    if op != 'I' and not pkeys:
+        raise Exception("%s needs pkeys" % ('update' if op == 'U' else 'delete'))
+
+    def qident(c: str) -> str:
+        return skytools.quote_ident(c).replace('%', '%%')
+
+    tbl = qtable.replace('%', '%%')
+    whe = " and ".join(["%s = %%s" % qident(c) for c in pkeys])
+    cols: Tuple[str, ...]
+    if op == 'I':
+        cols = tuple(fields)
+        sql_fmt = cmd % (tbl, ", ".join([qident(c) for c in cols]), ", ".join(["%s"] * len(cols)))
+    elif op == 'U':
+        set_cols = tuple([c for c in fields if c not in pkeys])
+        cols = set_cols + tuple(pkeys)
+        sql_fmt = cmd % (tbl, ", ".join(["%s = %%s" % qident(c) for c in set_cols]), whe)
+    else:
+        cols = tuple(pkeys)
+        sql_fmt = cmd % (tbl, whe)
+    return sql_fmt, cols
+
+
 class RowCache:
+    """Collects rows column-wise, rows are built once in apply_rows().
+
+    Columns missing from some rows are padded with None:
+
+    >>> c = RowCache('public.t')
+    >>> c.add_row({'id': 1, 'a': 'x'})
+    >>> c.add_row({'id': 2, 'b': 'y'})
+    >>> c.add_row({'b': 'z', 'id': 3})
+    >>> c.get_fields()
+    ('id', 'a', 'b')
+    >>> c.keys
+    {'id': 0, 'a': 1, 'b': 2}
+    >>> c.rows
+    [(1, 'x', None), (2, None, 'y'), (3, None, 'z')]
+    """
 
     table_name: str
-    keys: Dict[str, int]
-    rows: List[Tuple[Any, ...]]
+    columns: Dict[str, List[Any]]
+    row_count: int
 
     def __init__(self, table_name: str) -> None:
         self.table_name = table_name
-        self.keys = {}
-        self.rows = []
+        self.columns = {}
+        self.row_count = 0
 
     def add_row(self, d: Dict[str, Any]) -> None:
-        row = [None] * len(self.keys)
+        nrows = self.row_count
+        columns = self.columns
         for k, v in d.items():
-            try:
-                row[self.keys[k]] = v
-            except KeyError:
-                i = len(row)
-                self.keys[k] = i
-                row.append(v)
-        self.rows.append(tuple(row))
+            col = columns.get(k)
+            if col is None:
+                col = columns[k] = [None] * nrows
+            col.append(v)
+        self.row_count = nrows + 1
+
+        # pad columns missing from this row
+        if len(d) < len(columns):
+            for col in columns.values():
+                if len(col) == nrows:
+                    col.append(None)
 
     def get_fields(self) -> Sequence[str]:
-        row: List[str] = [""] * len(self.keys)
-        for k, i in self.keys.items():
-            row[i] = k
-        return tuple(row)
+        return tuple(self.columns)
+
+    @property
+    def keys(self) -> Dict[str, int]:
+        """Field name -> position in row, for compatibility."""
+        return {k: i for i, k in enumerate(self.columns)}
+
+    @property
+    def rows(self) -> List[Tuple[Any, ...]]:
+        """Collected rows as tuples in get_fields() order, for compatibility."""
+        return list(zip(*self.columns.values()))
 
     def apply_rows(self, curs: Cursor) -> None:
-        fields = self.get_fields()
-        skytools.magic_insert(curs, self.table_name, self.rows, fields)
+        """Load rows with COPY, data is quoted column at a time."""
+        if not self.row_count:
+            return
+        quote = skytools.quote_copy
+        qcols = [list(map(quote, col)) for col in self.columns.values()]
+        buf = io.StringIO()
+        for row in zip(*qcols):
+            buf.write("\t".join(row))
+            buf.write("\n")
+        buf.seek(0)
+        qfields = ",".join([skytools.quote_ident(f) for f in self.columns])
+        sql = "COPY %s (%s) FROM STDIN" % (skytools.quote_fqident(self.table_name), qfields)
+        curs.copy_expert(sql, buf)
 
 
 class BaseHandler:
@@ -99,15 +207,22 @@ class BaseHandler:
     args: Dict[str, str]
     conf: skytools.dbdict
     _doc_: str = ''
+    _valid_arg_names_cache: ClassVar[Optional[FrozenSet[str]]] = None
+    _config_cache: ClassVar[Optional[Dict[FrozenSet[Tuple[str, str]], dbdict]]] = None
+
+    # set in handler class whose get_config() depends only on args,
+    # then conf is shared between handlers and must be treated as read-only;
+    # not inherited, each subclass needs to opt in itself
+    config_cacheable: ClassVar[bool] = False
 
     def __init__(self, table_name: str, args: Optional[Dict[str,str]], dest_table: Optional[str]) -> None:
         self.table_name = table_name
         self.dest_table = dest_table or table_name
-        self.fq_table_name = skytools.quote_fqident(self.table_name)
-        self.fq_dest_table = skytools.quote_fqident(self.dest_table)
+        self.fq_table_name = sys.intern(skytools.quote_fqident(self.table_name))
+        self.fq_dest_table = sys.intern(skytools.quote_fqident(self.dest_table))
         self.args = args if args else {}
         self._check_args(self.args)
-        self.conf = self.get_config()
+        self.conf = self.load_config()
 
     def _parse_args_from_doc(self) -> List[Tuple[str, str, str]]:
         doc = self.__doc__ or ""
@@ -132,14 +247,18 @@ class BaseHandler:
         return params_descr
 
     def _check_args(self, args: Dict[str, str]) -> None:
-        self.valid_arg_names = []
-        passed_arg_names = args.keys() if args else []
-        args_from_doc = self._parse_args_from_doc()
-        if args_from_doc:
-            self.valid_arg_names = [arg[0] for arg in args_from_doc]
-        invalid = set(passed_arg_names) - set(self.valid_arg_names)
-        if invalid:
-            raise ValueError("Invalid handler argument: %s" % list(invalid))
+        if not args:
+            return
+        # doc is per-class, parse it only once
+        cls = type(self)
+        valid_arg_names = cls.__dict__.get('_valid_arg_names_cache')
+        if valid_arg_names is None:
+            valid_arg_names = frozenset(arg[0] for arg in self._parse_args_from_doc())
+            cls._valid_arg_names_cache = valid_arg_names
+        if args.keys() <= valid_arg_names:
+            return
+        invalid = args.keys() - valid_arg_names
+        raise ValueError("Invalid handler argument: %s" % list(invalid))
 
     def get_arg(self, name: str, value_list: Union[List[str], List[int]], default: Optional[Union[str, int]]=None) -> Union[str, int]:
         """ Return arg value or default; also check if value allowed. """
@@ -154,6 +273,20 @@ class BaseHandler:
         conf = skytools.dbdict()
         return conf
 
+    def load_config(self) -> dbdict:
+        """Return config for args, reused between handlers of same class."""
+        cls = type(self)
+        if not cls.__dict__.get('config_cacheable', False):
+            return self.get_config()
+        cache = cls.__dict__.get('_config_cache')
+        if cache is None:
+            cache = cls._config_cache = {}
+        key = frozenset(self.args.items())
+        conf = cache.get(key)
+        if conf is None:
+            conf = cache[key] = self.get_config()
+        return conf
+
     def add(self, trigger_arg_list: List[str]) -> None:
         """Called when table is added.
 
@@ -242,6 +375,7 @@ class TableHandler(BaseHandler):
       ignore_truncate=BOOL - Ignore truncate event. Default: 0; Values: 0,1.
     """
     handler_name = 'londiste'
+    config_cacheable = True
 
     sql_command = {
         'I': "insert into %s %s;",
@@ -251,8 +385,16 @@ class TableHandler(BaseHandler):
 
     allow_sql_event = 1
 
+    # max distinct row event types and row shapes to keep parsed
+    type_cache_size = 64
+
+    type_cache: Dict[str, Tuple[str, Tuple[str, ...]]]
+    sql_tmpl_cache: Dict[Tuple[str, Tuple[str, ...], Tuple[str, ...]], Tuple[str, Tuple[str, ...]]]
+
     def __init__(self, table_name: str, args: Dict[str, str], dest_table: Optional[str]) -> None:
         super().__init__(table_name, args, dest_table)
+        self.type_cache = {}
+        self.sql_tmpl_cache = {}
 
         enc = args.get('encoding')
         if enc:
@@ -265,46 +407,64 @@ class TableHandler(BaseHandler):
 
     def process_event(self, ev: Event, sql_queue_func: ApplyFunc, dst_curs: Cursor) -> None:
         row = self.parse_row_data(ev)
-        if len(ev.type) == 1:
+        ev_type = ev.type
+        if len(ev_type) == 1:
             # sql event
-            fqname = self.fq_dest_table
-            fmt = self.sql_command[ev.type]
-            sql = fmt % (fqname, row)
+            sql = self.sql_command[ev_type] % (self.fq_dest_table, row)
         else:
-            if ev.type[0] == '{':
-                jtype = json.loads(ev.type)
-                pklist = jtype['pkey']
-                op = jtype['op'][0]
-            else:
-                # urlenc event
-                pklist = ev.type[2:].split(',')
-                op = ev.type[0]
-            tbl = self.dest_table
-            if op == 'I':
-                sql = skytools.mk_insert_sql(row, tbl, pklist)
-            elif op == 'U':
-                sql = skytools.mk_update_sql(row, tbl, pklist)
-            elif op == 'D':
-                sql = skytools.mk_delete_sql(row, tbl, pklist)
+            # op and pkey list rarely change between events
+            parsed = self.type_cache.get(ev_type)
+            if parsed is None:
+                parsed = self.parse_event_type(ev_type)
+            op, pklist = parsed
+
+            # only values differ between rows of same shape
+            key = (op, pklist, tuple(row))
+            tmpl = self.sql_tmpl_cache.get(key)
+            if tmpl is None:
+                tmpl = self.make_sql_template(key)
+            sql_fmt, cols = tmpl
+            sql = sql_fmt % tuple(map(skytools.quote_literal, map(row.__getitem__, cols)))
 
         sql_queue_func(sql, dst_curs)
 
+    def make_sql_template(self, key: Tuple[str, Tuple[str, ...], Tuple[str, ...]]) -> Tuple[str, Tuple[str, ...]]:
+        """Build format string and value column order for row event shape, remember result."""
+        op, pklist, fields = key
+        tmpl = row_sql_template(op, self.fq_dest_table, pklist, fields)
+        if len(self.sql_tmpl_cache) >= self.type_cache_size:
+            self.sql_tmpl_cache.clear()
+        self.sql_tmpl_cache[key] = tmpl
+        return tmpl
+
+    def parse_event_type(self, ev_type: str) -> Tuple[str, Tuple[str, ...]]:
+        """Parse row event type into op and pkey list, remember result."""
+        if ev_type[0] == '{':
+            jtype = json_loads(ev_type)
+            parsed = (jtype['op'][0], tuple(jtype['pkey']))
+        else:
+            # urlenc event
+            parsed = (ev_type[0], tuple(ev_type[2:].split(',')))
+        if len(self.type_cache) >= self.type_cache_size:
+            self.type_cache.clear()
+        self.type_cache[ev_type] = parsed
+        return parsed
+
     def parse_row_data(self, ev: Event) -> Dict[str, Any]:
         """Extract row data from event, with optional encoding fixes.
 
         Returns either string (sql event) or dict (urlenc event).
         """
 
+        data = ev.data
         if len(ev.type) == 1:
             if not self.allow_sql_event:
                 raise Exception('SQL events not supported by this handler')
-            return ev.data
-        elif ev.data[0] == '{':
-            row = json.loads(ev.data)
-            return row
+            return data
+        elif data[0] == '{':
+            return json_loads(data)
         else:
-            row = skytools.db_urldecode(ev.data)
-            return row
+            return skytools.db_urldecode(data)
 
     def real_copy(self, src_tablename: str, src_curs: Cursor, dst_curs: Cursor, column_list: List[str]) -> Tuple[int, int]:
         """do actual table copy and return tuple with number of bytes and rows
@@ -365,19 +525,25 @@ def register_handler_module(modname: str, cf: skytools.Config) -> None:
 
 
 def _parse_arglist(arglist: Sequence[str]) -> Dict[str, str]:
-    args = {}
-    for arg in arglist or []:
-        key, _, val = arg.partition('=')
-        key = key.strip()
-        if key in args:
-            raise Exception('multiple handler arguments: %s' % key)
-        args[key] = val.strip()
+    parts = [arg.partition('=') for arg in arglist or []]
+    args = {key.strip(): val.strip() for key, _, val in parts}
+    if len(args) != len(parts):
+        seen = set()
+        for key, _, _ in parts:
+            key = key.strip()
+            if key in seen:
+                raise Exception('multiple handler arguments: %s' % key)
+            seen.add(key)
     return args
 
 
+# handler string: name(urlencoded args)
+_HSTR_RE = re.compile(r"([^(]+)\((.*)\)", re.S)
+
+
 def create_handler_string(name: str, arglist: Sequence[str]) -> str:
     handler = name
-    if name.find('(') >= 0:
+    if '(' in name:
         raise Exception('invalid handler name: %s' % name)
     if arglist:
         args = _parse_arglist(arglist)
@@ -387,16 +553,28 @@ def create_handler_string(name: str, arglist: Sequence[str]) -> str:
 
 
 def _parse_handler(hstr: str) -> Tuple[str, Dict[str, str]]:
-    """Parse result of create_handler_string()."""
+    """Parse result of create_handler_string().
+
+    >>> _parse_handler('londiste')
+    ('londiste', {})
+    >>> _parse_handler('dispatch(table_mode=part&period=day)')
+    ('dispatch', {'table_mode': 'part', 'period': 'day'})
+    >>> _parse_handler('bulk(method=1,analyze)')
+    ('bulk', {'method': '1'})
+    >>> _parse_handler('qsplitter(queue=a%28b%29)')
+    ('qsplitter', {'queue': 'a(b)'})
+    >>> _parse_handler('x(a=f(1))')
+    ('x', {'a': 'f(1)'})
+    """
     args = {}
     name = hstr
-    pos = hstr.find('(')
-    if pos > 0:
-        name = hstr[: pos]
-        if hstr[-1] != ')':
+    if hstr.find('(') > 0:
+        m = _HSTR_RE.fullmatch(hstr)
+        if not m:
             raise Exception('invalid handler format: %s' % hstr)
-        astr = hstr[pos + 1: -1]
+        name, astr = m.groups()
         if astr:
+            # args in handler string are separated by ','
             astr = astr.replace(',', '&')
             args = {
                 k: v
@@ -406,17 +584,21 @@ def _parse_handler(hstr: str) -> Tuple[str, Dict[str, str]]:
     return (name, args)
 
 
+# same handler string is usually used by many tables
+_parse_handler_cached = functools.lru_cache(maxsize=1024)(_parse_handler)
+
+
 def build_handler(tblname: str, hstr: str, dest_table: Optional[str] = None) -> BaseHandler:
     """Parse and initialize handler.
 
     hstr is result of create_handler_string()."""
-    hname, args = _parse_handler(hstr)
+    hname, args = _parse_handler_cached(hstr)
     # when no handler specified, use londiste
-    hname = hname or 'londiste'
-    klass = _handler_map[hname]
+    klass = _handler_map[hname or 'londiste']
     if not dest_table:
         dest_table = tblname
-    return klass(tblname, args, dest_table)
+    # parsed args are shared, handler gets own copy
+    return klass(tblname, dict(args), dest_table)
 
 
 #def load_handler_modules(cf: skytools.Config) -> None:
@@ -1,7 +1,6 @@
 """Handlers module
 """
 
-import functools
 import sys
 
 from typing import List, Callable, Dict, Type, Optional
@@ -14,16 +13,20 @@ DEFAULT_HANDLERS: List[str] = []
 ArgHandler = Callable[[Dict[str, str]], Dict[str,str]]
 ArgWrapper = Callable[[ArgHandler], ArgHandler]
 
-def handler_args(name: str, cls: Type[BaseHandler]) -> ArgWrapper:
+def handler_args(name: str, cls: Type[BaseHandler], *, mutates_args: bool = False) -> ArgWrapper:
     """Handler arguments initialization decorator
 
-    Define successor for handler class cls with func as argument generator
+    Define successor for handler class cls with func as argument generator.
+    func must return new dict and not modify its argument,
+    unless mutates_args is set, then it gets a copy.
     """
     def wrapper(func: ArgHandler) -> ArgHandler:
         # pylint: disable=unnecessary-dunder-call
         def _init_override(self: BaseHandler, table_name: str, args: Dict[str, str], dest_table: Optional[str]) -> None:
-            cls.__init__(self, table_name, func(args.copy()), dest_table)
-        dct = {'__init__': _init_override, 'handler_name': name}
+            cls.__init__(self, table_name, func(args.copy() if mutates_args else args), dest_table)
+        # only args change, so config caching of cls stays valid
+        dct = {'__init__': _init_override, 'handler_name': name,
+               'config_cacheable': cls.__dict__.get('config_cacheable', False)}
         module = sys.modules[cls.__module__]
         newname = '%s_%s' % (cls.__name__, name.replace('.', '_'))
         newcls = type(newname, (cls,), dct)
@@ -37,9 +40,10 @@ def handler_args(name: str, cls: Type[BaseHandler]) -> ArgWrapper:
 def update(*p: Dict[str, str]) -> Dict[str, str]:
     """ Update dicts given in params with its predecessor param dict
     in reverse order """
-    return functools.reduce(lambda x, y: x.update(y) or x,
-                            (p[i] for i in range(len(p) - 1, -1, -1)),
-                            {})
+    res: Dict[str, str] = {}
+    for d in reversed(p):
+        res.update(d)
+    return res
 
 
 def load_handler_modules(cf: skytools.Config) -> None:
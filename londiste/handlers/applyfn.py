@@ -1,14 +1,40 @@
 """Send all events to a DB function.
 """
 
-from typing import Optional, List, Type
+from typing import Optional, List, Type, Any, Dict, Callable
 
 import skytools
+from skytools import dbdict
 
 from londiste.handler import BaseHandler, BatchInfo, Cursor, Event, ApplyFunc
 
 __all__ = ['ApplyFuncHandler']
 
+# max events per function call statement in batched mode
+APPLY_BATCH_SIZE = 1000
+
+# function takes: fnconf, cur_tick + 10 event fields
+APPLY_FUNC_NARGS = 12
+
+
+def _quote_int(v: Any) -> str:
+    """Integers need no escaping, keep them as untyped literal."""
+    if v is None:
+        return 'null'
+    return "'%d'" % int(v)
+
+
+# quoting per function arg: fnconf, cur_tick, ev_id, ev_time, ev_txid, ev_retry,
+# ev_type, ev_data, ev_extra1..4
+_ARG_QUOTERS: List[Callable[[Any], str]] = [
+    skytools.quote_literal, _quote_int,
+    _quote_int, skytools.quote_literal,
+    _quote_int, _quote_int,
+    skytools.quote_literal, skytools.quote_literal,
+    skytools.quote_literal, skytools.quote_literal,
+    skytools.quote_literal, skytools.quote_literal,
+]
+
 
 class ApplyFuncHandler(BaseHandler):
     """Call DB function to apply event.
@@ -16,36 +42,114 @@ class ApplyFuncHandler(BaseHandler):
     Parameters:
       func_name=NAME - database function name
       func_conf=CONF - database function conf
+      batched=BOOL - Call function over unnest() arrays at batch end. Default: 0; Values: 0,1.
+          Calls run on dst_curs after SQL queued by other tables in the batch,
+          so function must not depend on order relative to other tables.
     """
     handler_name: str = 'applyfn'
+    config_cacheable = True
     cur_tick: Optional[int] = None
 
+    pending: List[List[Any]]
+    func_name: str
+    func_conf: str
+    sql_prefix: str
+    func_argtypes: Optional[List[str]] = None
+    func_argtypes_loaded: bool = False
+
+    def __init__(self, table_name: str, args: Optional[Dict[str, str]], dest_table: Optional[str]) -> None:
+        super().__init__(table_name, args, dest_table)
+        self.pending = []
+        self.func_name = self.args.get('func_name') or 'undefined'
+        self.func_conf = self.args.get('func_conf', '')
+        self.sql_prefix = "select %s(" % skytools.quote_fqident(self.func_name)
+
+    def get_config(self) -> dbdict:
+        conf = super().get_config()
+        conf.batched = self.get_arg('batched', [0, 1], 0)
+        return conf
+
+    def reset(self) -> None:
+        self.pending = []
+        super().reset()
+
     def prepare_batch(self, batch_info: Optional[BatchInfo], dst_curs: Cursor) -> None:
         if batch_info is not None:
             self.cur_tick = batch_info['tick_id']
+        self.pending = []
 
     def process_event(self, ev: Event, sql_queue_func: ApplyFunc, qfunc_arg: Cursor) -> None:
         """Ignore events for this table"""
-        fn = self.args.get('func_name') or 'undefined'
-        fnconf = self.args.get('func_conf', '')
-
-        args = [fnconf, self.cur_tick,
-                ev.ev_id, ev.ev_time,
-                ev.ev_txid, ev.ev_retry,
-                ev.ev_type, ev.ev_data,
-                ev.ev_extra1, ev.ev_extra2,
-                ev.ev_extra3, ev.ev_extra4]
-
-        qfn = skytools.quote_fqident(fn)
-        qargs = [skytools.quote_literal(a) for a in args]
-        sql = "select %s(%s);" % (qfn, ', '.join(qargs))
+        evargs = [ev.ev_id, ev.ev_time,
+                  ev.ev_txid, ev.ev_retry,
+                  ev.ev_type, ev.ev_data,
+                  ev.ev_extra1, ev.ev_extra2,
+                  ev.ev_extra3, ev.ev_extra4]
+
+        # collect, applied in finish_batch()
+        if self.conf.batched:
+            self.pending.append(evargs)
+            return
+
+        args = [self.func_conf, self.cur_tick] + evargs
+        qargs = [q(a) for q, a in zip(_ARG_QUOTERS, args)]
+        sql = self.sql_prefix + ', '.join(qargs) + ');'
         self.log.debug('applyfn.sql: %s', sql)
         sql_queue_func(sql, qfunc_arg)
 
+    def finish_batch(self, batch_info: BatchInfo, dst_curs: Cursor) -> None:
+        if self.pending:
+            self.flush_pending(dst_curs)
+
+    def flush_pending(self, dst_curs: Cursor) -> None:
+        """Apply collected events with one statement per APPLY_BATCH_SIZE events."""
+        fnconf = self.func_conf
+        argtypes = self.load_func_argtypes(dst_curs, self.func_name)
+        if argtypes is None:
+            # unknown or overloaded function, call per event
+            for evargs in self.pending:
+                qargs = [q(a) for q, a in zip(_ARG_QUOTERS, [fnconf, self.cur_tick] + evargs)]
+                dst_curs.execute(self.sql_prefix + ', '.join(qargs) + ');')
+            self.pending = []
+            return
+
+        # values go as text arrays, casted to function arg types
+        nevargs = APPLY_FUNC_NARGS - 2
+        fargs = ["%%s::%s" % argtypes[0], "%%s::%s" % argtypes[1]]
+        fargs += ["t.a%d::%s" % (i, argtypes[i + 2]) for i in range(nevargs)]
+        cols = ', '.join("a%d" % i for i in range(nevargs))
+        arrays = ', '.join(["%s::text[]"] * nevargs)
+        q = "%s%s) from unnest(%s) t (%s)" % (self.sql_prefix, ', '.join(fargs), arrays, cols)
+
+        for pos in range(0, len(self.pending), APPLY_BATCH_SIZE):
+            chunk = self.pending[pos: pos + APPLY_BATCH_SIZE]
+            columns = [[None if v is None else str(v) for v in col] for col in zip(*chunk)]
+            self.log.debug('applyfn.batch: %d events', len(chunk))
+            dst_curs.execute(q, [fnconf, self.cur_tick] + columns)
+        self.pending = []
+
+    def load_func_argtypes(self, curs: Cursor, fn: str) -> Optional[List[str]]:
+        """Return argument types of apply function, None if not unique.
+
+        Name is resolved by server the same way as in the call,
+        to_regproc() gives NULL for missing or overloaded function.
+        """
+        if not self.func_argtypes_loaded:
+            self.func_argtypes_loaded = True
+            q = "select p.proargtypes::regtype[]::text[] as argtypes"\
+                " from pg_catalog.pg_proc p"\
+                " where p.oid = to_regproc(%s) and p.pronargs = %s"
+            curs.execute(q, [skytools.quote_fqident(fn), APPLY_FUNC_NARGS])
+            rows = curs.fetchall()
+            if len(rows) == 1:
+                self.func_argtypes = list(rows[0]['argtypes'])
+            else:
+                self.log.warning('applyfn: cannot batch calls, function %s not unique', fn)
+        return self.func_argtypes
+
 #------------------------------------------------------------------------------
 # register handler class
 #------------------------------------------------------------------------------
 
 
 __londiste_handlers__: List[Type[BaseHandler]] = [ApplyFuncHandler]
-
@@ -113,6 +113,9 @@ method:
     * 1 (delete)  - as 'correct', but do update as DELETE + COPY
     * 2 (merged)  - as 'delete', but merge insert rows with update rows
     * 3 (insert)  - COPY inserts into table, error when other events
+    * 4 (merge)   - as 'correct', but update and delete rows are COPYed into
+                    one temp table and applied with single MERGE statement
+                    (PostgreSQL 15+)
 
 fields:
     field name map for using just part of the fields and rename them
@@ -162,17 +165,19 @@ creating or coping initial data to destination table.  --expect-sync and
 """
 
 import datetime
+import io
+import operator
 import re
 import logging
-from typing import Sequence, List, Tuple, Optional, Dict, Any, Callable, Mapping, Type, Set
+from typing import Sequence, List, Tuple, Optional, Dict, Any, Callable, Type, Set, Union, ClassVar
 
 import skytools
 from skytools import UsageError, quote_fqident, quote_ident, dbdict
 #from skytools.basetypes import DictRow
-from skytools.sqltools import DictRows
+from skytools.sqltools import DictRows, ListRows
 from skytools.dbstruct import T_ALL, TableStruct
 
-from londiste.handler import BatchInfo, Cursor, Event, ApplyFunc, BaseHandler
+from londiste.handler import BatchInfo, Cursor, Event, ApplyFunc, BaseHandler, row_sql_template
 from londiste.handlers import handler_args, update
 from londiste.handlers.shard import ShardHandler
 import londiste.util
@@ -184,11 +189,17 @@ METH_CORRECT = 0
 METH_DELETE = 1
 METH_MERGED = 2
 METH_INSERT = 3
+METH_MERGE = 4
 
 # BulkLoader hacks
 AVOID_BIZGRES_BUG = 0
 USE_LONGLIVED_TEMP_TABLES = True
 USE_REAL_TABLE = False
+# fewer deletes are done with key list, without temp table
+DIRECT_DELETE_LIMIT = 1000
+
+# DirectLoader: max rows in one multi-row insert
+DIRECT_INSERT_ROWS = 1000
 
 # mode variables (first in list is default value)
 TABLE_MODES = ['part', 'direct', 'ignore']
@@ -196,7 +207,7 @@ PART_MODES = ['batch_time', 'event_time', 'date_field', 'current_time']
 ROW_MODES = ['plain', 'keep_all', 'keep_latest']
 LOAD_MODES = ['direct', 'bulk']
 PERIODS = ['day', 'month', 'year', 'hour']
-METHODS = [METH_CORRECT, METH_DELETE, METH_MERGED, METH_INSERT]
+METHODS = [METH_CORRECT, METH_DELETE, METH_MERGED, METH_INSERT, METH_MERGE]
 
 EVENT_TYPES = ['I', 'U', 'D']
 
@@ -206,6 +217,12 @@ PART_FUNC_ARGS = ['parent', 'part', 'pkeys', 'part_field', 'part_time', 'period'
 
 RETENTION_FUNC = "londiste.drop_obsolete_partitions"
 
+# argument name line in module doc
+_PARAM_LINE_RE = re.compile(r"^(\w+):$")
+
+# temp table column for row operation, used by merge method
+MERGE_OP_COLUMN = "_londiste_op"
+
 
 #------------------------------------------------------------------------------
 # LOADERS
@@ -227,30 +244,91 @@ class BaseLoader:
     def process(self, op: str, row: Dict[str, Any]) -> None:
         raise NotImplementedError()
 
+    def is_empty(self) -> bool:
+        """True if there is nothing to flush"""
+        return False
+
     def flush(self, curs: Cursor) -> None:
         raise NotImplementedError()
 
 
 class DirectLoader(BaseLoader):
+    """Apply rows with plain SQL, keeping event order.
+
+    Consecutive inserts with same columns become one multi-row insert:
+
+    >>> class Curs:
+    ...     def execute(self, sql): print(sql)
+    >>> ldr = DirectLoader('public.t', ['id'], logging.getLogger('test'), skytools.dbdict())
+    >>> for op, row in [('I', {'id': '1', 'v': 'a'}), ('I', {'id': '2', 'v': None}),
+    ...                 ('U', {'id': '1', 'v': 'b'}), ('I', {'id': '3'})]:
+    ...     ldr.process(op, row)
+    >>> ldr.flush(Curs())
+    insert into public.t (id, v) values ('1', 'a'), ('2', null);
+    update only public.t set v = 'b' where id = '1';
+    insert into public.t (id) values ('3');
+    """
     data: List[Tuple[str, Dict[str, Any]]]
+    tmpl_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[str, Tuple[str, ...]]]
+    insert_cache: Dict[Tuple[str, ...], Tuple[str, str]]
+
     def __init__(self, table: str, pkeys: Sequence[str], log: logging.Logger, conf: skytools.dbdict) -> None:
         super().__init__(table, pkeys, log, conf)
         self.data = []
+        self.tmpl_cache = {}
+        self.insert_cache = {}
 
     def process(self, op: str, row: Dict[str, Any]) -> None:
         self.data.append((op, row))
 
+    def is_empty(self) -> bool:
+        return not self.data
+
     def flush(self, curs: Cursor) -> None:
-        mk_sql: Dict[str, Callable[
-            [Mapping[str, Any], str, Sequence[str], Optional[Mapping[str, str]]], str
-        ]] = {
-            'I': skytools.mk_insert_sql,
-            'U': skytools.mk_update_sql,
-            'D': skytools.mk_delete_sql
-        }
-        if self.data:
-            curs.execute("\n".join(mk_sql[op](row, self.table, self.pkeys, None)
-                                   for op, row in self.data))
+        if not self.data:
+            return
+        # statements keep event order, sql shape is built once per (op, columns)
+        qtable = quote_fqident(self.table)
+        quote = skytools.quote_literal
+        tmpl_cache = self.tmpl_cache
+        stmts = []
+        # consecutive inserts with same columns go into one statement
+        ins_fields = None
+        ins_prefix = ins_fmt = ''
+        ins_vals: List[str] = []
+        for op, row in self.data:
+            if op == 'I':
+                fields = tuple(row)
+                if fields != ins_fields or len(ins_vals) >= DIRECT_INSERT_ROWS:
+                    if ins_vals:
+                        stmts.append(ins_prefix + ", ".join(ins_vals) + ";")
+                        ins_vals = []
+                    ins_fields = fields
+                    ins_prefix, ins_fmt = self.insert_template(qtable, fields)
+                ins_vals.append(ins_fmt % tuple(map(quote, map(row.__getitem__, fields))))
+                continue
+            if ins_vals:
+                stmts.append(ins_prefix + ", ".join(ins_vals) + ";")
+                ins_vals = []
+                ins_fields = None
+            key = (op, tuple(row))
+            tmpl = tmpl_cache.get(key)
+            if tmpl is None:
+                tmpl = tmpl_cache[key] = row_sql_template(op, qtable, self.pkeys, key[1])
+            sql_fmt, cols = tmpl
+            stmts.append(sql_fmt % tuple(map(quote, map(row.__getitem__, cols))))
+        if ins_vals:
+            stmts.append(ins_prefix + ", ".join(ins_vals) + ";")
+        curs.execute("\n".join(stmts))
+
+    def insert_template(self, qtable: str, fields: Tuple[str, ...]) -> Tuple[str, str]:
+        """Return insert statement start and row values format for fields"""
+        tmpl = self.insert_cache.get(fields)
+        if tmpl is None:
+            prefix = "insert into %s (%s) values " % (qtable, ", ".join([quote_ident(f) for f in fields]))
+            fmt = "(%s)" % ", ".join(["%s"] * len(fields))
+            tmpl = self.insert_cache[fields] = (prefix, fmt)
+        return tmpl
 
 
 class BaseBulkCollectingLoader(BaseLoader):
@@ -269,34 +347,56 @@ class BaseBulkCollectingLoader(BaseLoader):
                 }
 
     pkey_ev_map: Dict[Tuple[str, ...], Tuple[str, Dict[str, Any]]]
+    pkey_getter: Callable[[Dict[str, Any]], Tuple[str, ...]]
 
     def __init__(self, table: str, pkeys: Sequence[str], log: logging.Logger, conf: skytools.dbdict) -> None:
         super().__init__(table, pkeys, log, conf)
         if not self.pkeys:
             raise Exception('non-pk tables not supported: %s' % self.table)
         self.pkey_ev_map = {}
+        # itemgetter gives tuple only for several keys
+        if len(self.pkeys) > 1:
+            self.pkey_getter = operator.itemgetter(*self.pkeys)
+        else:
+            pkey = self.pkeys[0]
+            self.pkey_getter = lambda row: (row[pkey],)
 
     def process(self, op: str, row: Dict[str, Any]) -> None:
         """Collect rows into pk dict, keeping only last row with most
         suitable op"""
-        pk_data: Tuple[str, ...] = tuple(row[k] for k in self.pkeys)
-        # get current op state, None if first event
-        _op = self.pkey_ev_map.get(pk_data, ('-', {}))[0]
+        pkey_ev_map = self.pkey_ev_map
+        pk_data = self.pkey_getter(row)
+        # get current op state, '-' if first event
+        cur = pkey_ev_map.get(pk_data)
+        _op = cur[0] if cur is not None else '-'
         # find new state and store together with row data
         try:
             # get new op state using op graph
             # when no edge defined for old -> new op, keep old
             _op = self.OP_GRAPH[_op].get(op, _op)
-            self.pkey_ev_map[pk_data] = (_op, row)
 
             # skip update to pk-only table
-            if len(pk_data) == len(row) and _op == 'U':
-                del self.pkey_ev_map[pk_data]
+            if _op == 'U' and len(pk_data) == len(row):
+                if cur is not None:
+                    del pkey_ev_map[pk_data]
+            else:
+                pkey_ev_map[pk_data] = (_op, row)
         except KeyError:
             raise Exception('unknown event type: %s' % op) from None
 
+    def is_empty(self) -> bool:
+        return not self.pkey_ev_map
+
     def collect_data(self) -> Dict[str, List[Dict[str, Any]]]:
         """Collects list of rows into operation hashed dict
+
+        >>> ldr = BaseBulkCollectingLoader('public.t', ['id'], logging.getLogger('test'), skytools.dbdict())
+        >>> for op, row in [('I', {'id': 1, 'v': 'a'}), ('U', {'id': 1, 'v': 'b'}),
+        ...                 ('I', {'id': 2, 'v': 'c'}), ('D', {'id': 2, 'v': 'c'}),
+        ...                 ('D', {'id': 3, 'v': 'd'}), ('I', {'id': 3, 'v': 'e'})]:
+        ...     ldr.process(op, row)
+        >>> ldr.collect_data()
+        {'I': [{'id': 1, 'v': 'b'}], 'U': [{'id': 3, 'v': 'e'}], 'D': []}
         """
         op_map: Dict[str, List[Dict[str, Any]]] = {'I': [], 'U': [], 'D': []}
         for op, row in self.pkey_ev_map.values():
@@ -321,6 +421,8 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
     temp: str
     qtemp: str
     qtable: str
+    sql_parts: Dict[Tuple[str, Tuple[str, ...]], str]
+    qnames: Dict[str, str]
 
     def __init__(self, table: str, pkeys: Sequence[str], log: logging.Logger, conf: skytools.dbdict) -> None:
         super().__init__(table, pkeys, log, conf)
@@ -338,6 +440,10 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
         # key fields used in where part, possible to add non pk fields
         # (like dist keys in gp)
         self.keys = list(self.pkeys)
+        # quoted sql parts by (part, field list)
+        self.sql_parts = {}
+        # quoted field names
+        self.qnames = {}
 
     def nonkeys(self) -> List[str]:
         """returns fields not in keys"""
@@ -353,32 +459,52 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
 
     # create sql parts
 
+    def _q(self, name: str) -> str:
+        qname = self.qnames.get(name)
+        if qname is None:
+            qname = self.qnames[name] = quote_ident(name)
+        return qname
+
     def _where(self) -> str:
-        tmpl = "%(tbl)s.%(col)s = t.%(col)s"
-        stmt = (tmpl % {'col': quote_ident(f), 'tbl': self.qtable}
-                for f in self.keys)
-        return ' and '.join(stmt)
+        key = ('where', tuple(self.keys))
+        sql = self.sql_parts.get(key)
+        if sql is None:
+            tmpl = "%(tbl)s.%(col)s = t.%(col)s"
+            stmt = (tmpl % {'col': self._q(f), 'tbl': self.qtable}
+                    for f in self.keys)
+            sql = self.sql_parts[key] = ' and '.join(stmt)
+        return sql
 
     def _cols(self) -> str:
         if not self.fields:
             return ''
-        return ','.join(quote_ident(f) for f in self.fields)
+        key = ('cols', tuple(self.fields))
+        sql = self.sql_parts.get(key)
+        if sql is None:
+            sql = self.sql_parts[key] = ','.join(self._q(f) for f in self.fields)
+        return sql
+
+    def _set(self) -> str:
+        key = ('set', tuple(self.nonkeys()))
+        sql = self.sql_parts.get(key)
+        if sql is None:
+            tmpl = "%s = t.%s"
+            qcols = [self._q(c) for c in key[1]]
+            sql = self.sql_parts[key] = ", ".join(tmpl % (c, c) for c in qcols)
+        return sql
 
     def insert(self, curs: Cursor) -> None:
-        sql = "insert into %s (%s) select %s from %s" % (self.qtable, self._cols(), self._cols(), self.qtemp)
+        cols = self._cols()
+        sql = "insert into %s (%s) select %s from %s" % (self.qtable, cols, cols, self.qtemp)
         self.logexec(curs, sql)
 
     def update(self, curs: Cursor) -> None:
-        qcols = [quote_ident(c) for c in self.nonkeys()]
+        _set = self._set()
 
         # no point to update pk-only table
-        if not qcols:
+        if not _set:
             return
 
-        tmpl = "%s = t.%s"
-        eqlist = [tmpl % (c, c) for c in qcols]
-        _set = ", ".join(eqlist)
-
         sql = "update only %s set %s from %s as t where %s" % (self.qtable, _set, self.qtemp, self._where())
         self.logexec(curs, sql)
 
@@ -386,6 +512,41 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
         sql = "delete from only %s using %s as t where %s" % (self.qtable, self.qtemp, self._where())
         self.logexec(curs, sql)
 
+    def delete_keys(self, curs: Cursor, data: DictRows) -> None:
+        """Delete rows by key values given in statement
+
+        >>> class Curs:
+        ...     statusmessage, rowcount = 'DELETE 2', 2
+        ...     def execute(self, sql): print(sql)
+        >>> log = logging.getLogger('test')
+        >>> ldr = BaseBulkTempLoader('public.t', ['id'], log, skytools.dbdict())
+        >>> ldr.delete_keys(Curs(), [{'id': '1'}, {'id': "it's"}])
+        delete from only public.t where id in ('1', 'it''s')
+        >>> ldr = BaseBulkTempLoader('public.t', ['a', 'B'], log, skytools.dbdict())
+        >>> ldr.delete_keys(Curs(), [{'a': '1', 'B': '2'}, {'a': '3', 'B': '4'}])
+        delete from only public.t where (a, "B") in (('1', '2'), ('3', '4'))
+        """
+        quote = skytools.quote_literal
+        keys = self.keys
+        if len(keys) == 1:
+            qkeys = self._q(keys[0])
+            vals = ", ".join([quote(row[keys[0]]) for row in data])
+        else:
+            qkeys = "(%s)" % ", ".join([self._q(k) for k in keys])
+            vals = ", ".join(["(%s)" % ", ".join([quote(row[k]) for k in keys]) for row in data])
+        sql = "delete from only %s where %s in (%s)" % (self.qtable, qkeys, vals)
+        self.logexec(curs, sql)
+
+    def merge(self, curs: Cursor) -> None:
+        """Apply U/D rows from temp table, operation is in MERGE_OP_COLUMN"""
+        qop = self._q(MERGE_OP_COLUMN)
+        sql = "merge into %s using %s as t on %s" % (self.qtable, self.qtemp, self._where())
+        sql += " when matched and t.%s = 'D' then delete" % qop
+        _set = self._set()
+        if _set:
+            sql += " when matched and t.%s = 'U' then update set %s" % (qop, _set)
+        self.logexec(curs, sql)
+
     def truncate(self, curs: Cursor) -> None:
         self.logexec(curs, "truncate %s" % self.qtemp)
 
@@ -404,25 +565,55 @@ class BaseBulkTempLoader(BaseBulkCollectingLoader):
 
     def process(self, op: str, row: Dict[str, Any]) -> None:
         super().process(op, row)
-        # TODO: maybe one assignment is enough?
-        self.fields = list(row.keys())
+        # all row events of a table carry same fields, unless
+        # table was altered mid-batch - then latest row wins, as before
+        fields = self.fields
+        if fields is None:
+            self.fields = list(row)
+        elif len(row) != len(fields):
+            self.log.warning("%s: row fields changed in batch: %s -> %s",
+                             self.table, ",".join(fields), ",".join(row))
+            self.fields = list(row)
 
 
 class BulkLoader(BaseBulkTempLoader):
     """ Collects events to and loads bulk data using copy and temp tables
+
+    Method 4 (merge) copies updates and deletes into temp table
+    and applies them with one MERGE, inserts are copied directly:
+
+    >>> class Curs:
+    ...     statusmessage, rowcount = 'OK', 2
+    ...     def execute(self, sql): print(sql)
+    ...     def copy_expert(self, sql, buf): print(sql); print(buf.read().replace('\\t', ' '), end='')
+    >>> conf = skytools.dbdict(method=METH_MERGE, analyze=0, table_mode='direct')
+    >>> ldr = BulkLoader('public.t', ['id'], logging.getLogger('test'), conf)
+    >>> ldr.dist_fields, ldr.temp_present = [], True
+    >>> for op, row in [('U', {'id': '1', 'v': 'a'}), ('D', {'id': '2', 'v': 'b'}),
+    ...                 ('I', {'id': '3', 'v': 'c'})]:
+    ...     ldr.process(op, row)
+    >>> ldr.flush(Curs())
+    truncate public_t_loadertmp
+    COPY public_t_loadertmp (id,v,_londiste_op) FROM STDIN
+    2 b D
+    1 a U
+    merge into public.t using public_t_loadertmp as t on public.t.id = t.id when matched and t._londiste_op = 'D' then delete when matched and t._londiste_op = 'U' then update set v = t.v
+    COPY public.t (id,v) FROM STDIN
+    3 c
+    truncate public_t_loadertmp
     """
     dist_fields: Optional[List[str]]
     run_analyze: int
     method: int
-    temp_present: bool
+    temp_present: Optional[bool]
 
     def __init__(self, table: str, pkeys: Sequence[str], log: logging.Logger, conf: skytools.dbdict) -> None:
         super().__init__(table, pkeys, log, conf)
         self.method = self.conf['method']
         self.run_analyze = self.conf['analyze']
         self.dist_fields = None
-        # is temp table created
-        self.temp_present = False
+        # is temp table created, None if not checked yet
+        self.temp_present = None
 
     def process(self, op: str, row: Dict[str, Any]) -> None:
         if self.method == METH_INSERT and op != 'I':
@@ -436,10 +627,13 @@ class BulkLoader(BaseBulkTempLoader):
         if cnt == 0:
             return
         self.log.debug("bulk: Deleting %d rows from %s", cnt, self.table)
-        # copy rows to temp
-        self.bulk_insert(curs, data)
-        # delete rows using temp
-        self.delete(curs)
+        if cnt < DIRECT_DELETE_LIMIT:
+            self.delete_keys(curs, data)
+        else:
+            # copy rows to temp
+            self.bulk_insert(curs, data)
+            # delete rows using temp
+            self.delete(curs)
         # check if right amount of rows deleted (only in direct mode)
         if self.conf.table_mode == 'direct' and cnt != curs.rowcount:
             self.log.warning("%s: Delete mismatch: expected=%s deleted=%d",
@@ -493,10 +687,35 @@ class BulkLoader(BaseBulkTempLoader):
         # copy into target table (no temp used)
         self.bulk_insert(curs, data, table=self.qtable)
 
+    def process_merge(self, curs: Cursor, op_map: Dict[str, List[Dict[str, Any]]]) -> None:
+        """Process update and delete lists with one COPY and MERGE, then inserts.
+
+        Inserts go directly to table as in 'correct' method, so existing
+        key gives error instead of being silently skipped.
+        """
+        fields = self.fields or []
+        data = [[row.get(f) for f in fields] + [op]
+                for op in ('D', 'U') for row in op_map[op]]
+        cnt = len(data)
+        if cnt > 0:
+            self.log.debug("bulk: Merging %d rows into %s", cnt, self.table)
+            # copy rows to temp, with operation
+            self.bulk_insert(curs, data, fields=fields + [MERGE_OP_COLUMN])
+            self.merge(curs)
+            # check count (only in direct mode)
+            if self.conf.table_mode == 'direct' and cnt != curs.rowcount:
+                self.log.warning("%s: Merge mismatch: expected=%s merged=%d",
+                                 self.table, cnt, curs.rowcount)
+        self.process_insert(curs, op_map)
+
     def bulk_flush(self, curs: Cursor, op_map: Dict[str, List[Dict[str, Any]]]) -> None:
         self.log.debug("bulk_flush: %s  (I/U/D = %d/%d/%d)", self.table,
                        len(op_map['I']), len(op_map['U']), len(op_map['D']))
 
+        # all events cancelled each other
+        if not any(op_map.values()):
+            return
+
         # fetch distribution fields
         if self.dist_fields is None:
             self.dist_fields = self.find_dist_fields(curs)
@@ -509,12 +728,13 @@ class BulkLoader(BaseBulkTempLoader):
                 if key not in self.keys:
                     self.keys.append(key)
 
-        # check if temp table present
-        self.check_temp(curs)
         # process I,U,D
-        self.process_delete(curs, op_map)
-        self.process_update(curs, op_map)
-        self.process_insert(curs, op_map)
+        if self.method == METH_MERGE:
+            self.process_merge(curs, op_map)
+        else:
+            self.process_delete(curs, op_map)
+            self.process_update(curs, op_map)
+            self.process_insert(curs, op_map)
         # truncate or drop temp table
         self.clean_temp(curs)
 
@@ -537,15 +757,21 @@ class BulkLoader(BaseBulkTempLoader):
         """ check if temp table exists. Returns False if using existing temp
         table and True if creating new
         """
+        # check temp table only when it is needed
+        if self.temp_present is None:
+            self.check_temp(curs)
         if USE_LONGLIVED_TEMP_TABLES or USE_REAL_TABLE:
             if self.temp_present:
                 self.log.debug("bulk: Using existing temp table %s", self.temp)
                 return False
         self.create(curs)
+        if self.method == METH_MERGE:
+            self.logexec(curs, "alter table %s add column %s text" % (self.qtemp, quote_ident(MERGE_OP_COLUMN)))
         self.temp_present = True
         return True
 
-    def bulk_insert(self, curs: Cursor, data: DictRows, table: Optional[str] = None) -> None:
+    def bulk_insert(self, curs: Cursor, data: Union[DictRows, ListRows], table: Optional[str] = None,
+                    fields: Optional[List[str]] = None) -> None:
         """Copy data to table. If table not provided, use temp table.
         When re-using existing temp table, it is always truncated first and
         analyzed after copy.
@@ -553,15 +779,24 @@ class BulkLoader(BaseBulkTempLoader):
         if not data:
             return
         _use_temp = table is None
-        xtable = self.temp if table is None else table
+        xtable = self.qtemp if table is None else table
         # if table not specified use temp
         if _use_temp:
             # truncate when re-using existing table
             if not self.create_temp(curs):
                 self.truncate(curs)
         self.log.debug("bulk: COPY %d rows into %s", len(data), xtable)
-        skytools.magic_insert(curs, xtable, data, self.fields,
-                              quoted_table=True)
+        fields = fields or self.fields or []
+        # rows are dicts or lists in fields order
+        quote = skytools.quote_copy
+        buf = io.StringIO()
+        for row in data:
+            vals = map(row.get, fields) if isinstance(row, dict) else row
+            buf.write("\t".join(map(quote, vals)))
+            buf.write("\n")
+        buf.seek(0)
+        sql = "COPY %s (%s) FROM STDIN" % (xtable, ",".join([self._q(f) for f in fields]))
+        curs.copy_expert(sql, buf)
         if _use_temp and self.run_analyze:
             self.analyze(curs)
 
@@ -611,7 +846,8 @@ class RowHandler:
 
     def flush(self, curs: Cursor) -> None:
         for ldr in self.table_map.values():
-            ldr.flush(curs)
+            if not ldr.is_empty():
+                ldr.flush(curs)
 
 
 class KeepAllRowHandler(RowHandler):
@@ -653,17 +889,44 @@ ROW_HANDLERS = {'plain': RowHandler,
 # DISPATCHER
 #------------------------------------------------------------------------------
 
+def parse_part_time(dt_str: str) -> datetime.datetime:
+    """Parse date_field value as "YYYY-MM-DD HH:MM:SS", rest is ignored.
+
+    >>> parse_part_time('2024-01-05 10:20:30.123+02')
+    datetime.datetime(2024, 1, 5, 10, 20, 30)
+    >>> parse_part_time('2024-1-5 1:2:3')
+    datetime.datetime(2024, 1, 5, 1, 2, 3)
+    >>> parse_part_time('2024-01-05')
+    Traceback (most recent call last):
+        ...
+    ValueError: time data '2024-01-05' does not match format '%Y-%m-%d %H:%M:%S'
+    """
+    val = dt_str[:19]
+    # usual timestamp text goes via fromisoformat, strptime is slow
+    if len(val) == 19 and val[4] == '-' and val[7] == '-' and val[10] == ' ':
+        try:
+            return datetime.datetime.fromisoformat(val)
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(val, "%Y-%m-%d %H:%M:%S")
+
+
 class Dispatcher(ShardHandler):
     _doc_ = """Partitioned loader.
     Splits events into partitions, if requested.
     Then applies them without further processing.
     """
     handler_name = 'dispatch'
+    config_cacheable = True
 
     dst_curs: Optional[Cursor]
     ignored_tables: Set[str]
     batch_info: Optional[BatchInfo]
     pkeys: Optional[List[str]]
+    projector: Callable[[Dict[str, Any]], Dict[str, Any]]
+    part_name_cache: Dict[Tuple[int, int, int, int], str]
+    part_name_tmpl: str
+    _args_descr: ClassVar[Optional[List[Tuple[str, str, str]]]] = None
 
     @property
     def __doc__(self) -> Optional[str]:
@@ -688,8 +951,20 @@ class Dispatcher(ShardHandler):
         # config
         hdlr_cls = ROW_HANDLERS[self.conf.row_mode]
         self.row_handler = hdlr_cls(self.log)
+        self.projector = self.make_projector()
+        self.part_name_cache = {}
+        self.part_name_tmpl = ''
+        if self.conf.table_mode == 'part':
+            self.part_name_tmpl = self.get_part_name()
 
     def _parse_args_from_doc(self) -> List[Tuple[str, str, str]]:
+        # module doc is same for all subclasses
+        if Dispatcher._args_descr is None:
+            Dispatcher._args_descr = self._parse_module_doc()
+        return list(Dispatcher._args_descr)
+
+    @staticmethod
+    def _parse_module_doc() -> List[Tuple[str, str, str]]:
         doc = __doc__
         params_descr: List[Tuple[str, str, str]] = []
         params_found = False
@@ -698,7 +973,7 @@ class Dispatcher(ShardHandler):
             if params_found:
                 if ln.startswith("=="):
                     break
-                m = re.match(r"^(\w+):$", ln)
+                m = _PARAM_LINE_RE.match(ln)
                 if m:
                     name = m.group(1)
                     expr = text = ""
@@ -741,7 +1016,7 @@ class Dispatcher(ShardHandler):
             for evt in event_types:
                 if evt not in EVENT_TYPES:
                     raise Exception('Unsupported operation: %s' % evt)
-        conf.event_types = event_types
+        conf.event_types = frozenset(event_types)
         # set load handler
         conf.load_mode = self.get_arg('load_mode', LOAD_MODES)
         conf.method = self.get_arg('method', METHODS)
@@ -770,20 +1045,41 @@ class Dispatcher(ShardHandler):
         if batch_info is not None and self.conf.table_mode != 'ignore':
             self.batch_info = batch_info
             self.dst_curs = dst_curs
+            # fail before any loader is created, not on first flush
+            if (self.conf.load_mode == 'bulk' and self.conf.method == METH_MERGE
+                    and dst_curs.connection.server_version < 150000):
+                raise UsageError('%s: method 4 (merge) needs PostgreSQL 15+, server is %d'
+                                 % (self.table_name, dst_curs.connection.server_version))
         super().prepare_batch(batch_info, dst_curs)
 
+    def make_projector(self) -> Callable[[Dict[str, Any]], Dict[str, Any]]:
+        """Compile fields skip and map into single row function
+
+        >>> row = {'id': '1', 'a': 'x', 'b': 'y'}
+        >>> Dispatcher('public.t', {'table_mode': 'direct', 'skip_fields': 'b'}, 'public.t').projector(row)
+        {'id': '1', 'a': 'x'}
+        >>> Dispatcher('public.t', {'table_mode': 'direct', 'fields': 'id,a:aa,c'}, 'public.t').projector(row)
+        {'id': '1', 'aa': 'x', 'c': None}
+        >>> Dispatcher('public.t', {'table_mode': 'direct', 'fields': 'id,a',
+        ...                         'skip_fields': 'a'}, 'public.t').projector(row)
+        {'id': '1', 'a': None}
+        """
+        # empty name comes from empty skip_fields, no column has it
+        fskip = frozenset(self.conf.skip_fields) - {''}
+        fmap = tuple(self.conf.field_map.items()) if self.conf.field_map else ()
+        # when field name not present in source is used then  None (NULL)
+        # value is inserted. is it ok?
+        if fmap:
+            # skipped fields are mapped as missing ones
+            fmap = tuple(('' if k in fskip else k, v) for k, v in fmap)
+            return lambda data: {v: data.get(k) for k, v in fmap}
+        if fskip:
+            return lambda data: {k: v for k, v in data.items() if k not in fskip}
+        return lambda data: data
+
     def filter_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """Process with fields skip and map"""
-        fskip = self.conf.skip_fields
-        fmap = self.conf.field_map
-        if fskip:
-            data = dict((k, v) for k, v in data.items()
-                        if k not in fskip)
-        if fmap:
-            # when field name not present in source is used then  None (NULL)
-            # value is inserted. is it ok?
-            data = dict((v, data.get(k)) for k, v in fmap.items())
-        return data
+        return self.projector(data)
 
     def filter_pkeys(self, pkeys: List[str]) -> List[str]:
         """Process with fields skip and map"""
@@ -799,39 +1095,50 @@ class Dispatcher(ShardHandler):
         """Process a event.
         Event should be added to sql_queue or executed directly.
         """
-        if self.conf.table_mode == 'ignore':
+        conf = self.conf
+        table_mode = conf.table_mode
+        if table_mode == 'ignore':
             return
-        # get data
-        data = skytools.db_urldecode(ev.data)
-        if len(ev.ev_type) < 2 or ev.ev_type[1] != ':':
+        ev_type = ev.ev_type
+        if len(ev_type) < 2 or ev_type[1] != ':':
             raise Exception('Unsupported event type: %s/extra1=%s/data=%s' % (
-                            ev.ev_type, ev.ev_extra1, ev.ev_data))
-        op, pkeys = ev.type.split(':', 1)
+                            ev_type, ev.ev_extra1, ev.ev_data))
+        op, pkeys = ev_type.split(':', 1)
         if op not in 'IUD':
-            raise Exception('Unknown event type: %s' % ev.ev_type)
+            raise Exception('Unknown event type: %s' % ev_type)
         # process only operations specified
-        if op not in self.conf.event_types:
+        if op not in conf.event_types:
             #self.log.debug('dispatch.process_event: ignored event type')
             return
+        # skip ignored partitions before parsing data, when possible
+        split = None
+        if table_mode == 'part' and conf.part_mode != 'date_field':
+            split = self.split_format(ev, {})
+            if split[0] in self.ignored_tables:
+                return
+        # get data
+        data = skytools.db_urldecode(ev.data)
         if self.pkeys is None:
             self.pkeys = self.filter_pkeys(pkeys.split(','))
         data = self.filter_data(data)
+        row_handler = self.row_handler
+        table_map = row_handler.table_map
         # prepare split table when needed
-        if self.conf.table_mode == 'part':
-            dst, part_time = self.split_format(ev, data)
+        if table_mode == 'part':
+            dst, part_time = split or self.split_format(ev, data)
             if dst in self.ignored_tables:
                 return
-            if dst not in self.row_handler.table_map:
+            if dst not in table_map:
                 self.check_part(dst, part_time)
                 if dst in self.ignored_tables:
                     return
         else:
             dst = self.dest_table
 
-        if dst not in self.row_handler.table_map:
-            self.row_handler.add_table(dst, LOADERS[self.conf.load_mode],
-                                       self.pkeys, self.conf)
-        self.row_handler.process(dst, op, data)
+        if dst not in table_map:
+            row_handler.add_table(dst, LOADERS[conf.load_mode],
+                                  self.pkeys, conf)
+        row_handler.process(dst, op, data)
 
     def finish_batch(self, batch_info: BatchInfo, dst_curs: Cursor) -> None:
         """Called when batch finishes."""
@@ -860,17 +1167,22 @@ class Dispatcher(ShardHandler):
             dt_str = data[self.conf.part_field]
             if dt_str is None:
                 raise Exception('part_field(%s) is NULL: %s' % (self.conf.part_field, ev))
-            dtm = datetime.datetime.strptime(dt_str[:19], "%Y-%m-%d %H:%M:%S")
+            dtm = parse_part_time(dt_str)
         else:
             raise UsageError('Bad value for part_mode: %s' % self.conf.part_mode)
-        vals = {
-            'parent': self.dest_table,
-            'year': "%04d" % dtm.year,
-            'month': "%02d" % dtm.month,
-            'day': "%02d" % dtm.day,
-            'hour': "%02d" % dtm.hour,
-        }
-        return (self.get_part_name() % vals, dtm)
+        # consecutive events mostly go to same partition
+        key = (dtm.year, dtm.month, dtm.day, dtm.hour)
+        name = self.part_name_cache.get(key)
+        if name is None:
+            vals = {
+                'parent': self.dest_table,
+                'year': "%04d" % dtm.year,
+                'month': "%02d" % dtm.month,
+                'day': "%02d" % dtm.day,
+                'hour': "%02d" % dtm.hour,
+            }
+            name = self.part_name_cache[key] = self.part_name_tmpl % vals
+        return (name, dtm)
 
     def check_part(self, dst: str, part_time: datetime.datetime) -> None:
         """Create part table if not exists.
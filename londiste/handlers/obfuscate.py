@@ -15,14 +15,14 @@ import json
 import uuid
 from hashlib import blake2s
 
-from typing import Dict, Any, Sequence, Tuple, Optional, List, cast
+from typing import Dict, Any, Sequence, Tuple, Optional, List, Callable, cast
 
 from skytools.basetypes import Cursor, DictRow
 import skytools
 import yaml
 
 from pgq.event import Event
-from londiste.handler import TableHandler
+from londiste.handler import TableHandler, json_loads
 import londiste.util
 
 
@@ -30,6 +30,10 @@ __all__ = ['Obfuscator']
 
 _KEY = b''
 
+# keyed hash states per digest size, copied for each value
+# so key setup is done only once
+_HASH_PROTO: Dict[int, Any] = {}
+
 BOOL = 'bool'
 KEEP = 'keep'
 JSON = 'json'
@@ -38,12 +42,22 @@ HASH64 = 'hash64'
 HASH128 = 'hash'
 SKIP = 'skip'
 
+# libyaml loader when compiled in
+_YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 RuleDict = Dict[str, Any]
+ObfFunc = Callable[[Any], Any]
 
 
 def as_bytes(data: Any) -> bytes:
     """Convert input string or json value into bytes.
     """
+    # exact types first, row values are mostly str
+    cls = type(data)
+    if cls is str:
+        return data.encode()
+    if cls is int:
+        return b'%d' % data
     if isinstance(data, str):
         return data.encode('utf8')
     if isinstance(data, int):
@@ -59,12 +73,33 @@ def as_bytes(data: Any) -> bytes:
     raise ValueError('Invalid input type for hashing: %s' % type(data))
 
 
+def set_key(key: bytes) -> None:
+    """Set hashing key and prepare keyed hash states.
+    """
+    global _KEY
+    _KEY = key
+    _HASH_PROTO.clear()
+    for digest_size in (4, 8, 16):
+        _HASH_PROTO[digest_size] = blake2s(digest_size=digest_size, key=key)
+
+
+def keyed_digest(data: Any, digest_size: int) -> bytes:
+    """Return keyed hash of value with given digest size.
+    """
+    h = _HASH_PROTO[digest_size].copy()
+    h.update(as_bytes(data))
+    return h.digest()
+
+
+set_key(_KEY)
+
+
 def hash32(data: Any) -> Optional[int]:
     """Returns hash as 32-bit signed int.
     """
     if data is None:
         return None
-    hash_bytes = blake2s(as_bytes(data), digest_size=4, key=_KEY).digest()
+    hash_bytes = keyed_digest(data, 4)
     return int.from_bytes(hash_bytes, byteorder='big', signed=True)
 
 
@@ -73,7 +108,7 @@ def hash64(data: Any) -> Optional[int]:
     """
     if data is None:
         return None
-    hash_bytes = blake2s(as_bytes(data), digest_size=8, key=_KEY).digest()
+    hash_bytes = keyed_digest(data, 8)
     return int.from_bytes(hash_bytes, byteorder='big', signed=True)
 
 
@@ -82,7 +117,7 @@ def hash128(data: Any) -> Optional[str]:
     """
     if data is None:
         return None
-    hash_bytes = blake2s(as_bytes(data), digest_size=16, key=_KEY).digest()
+    hash_bytes = keyed_digest(data, 16)
     hash_int = int.from_bytes(hash_bytes, byteorder='big')
 
     # rfc4122 variant bit:
@@ -93,15 +128,48 @@ def hash128(data: Any) -> Optional[str]:
     return str(uuid.UUID(int=hash_int))
 
 
-def data_to_dict(data: str, column_list: Sequence[str]) -> Dict[str, Any]:
-    """Convert data received from copy to dict
+def obf_keep(data: Any) -> Any:
+    """Returns value unchanged.
+    """
+    return data
+
+
+def obf_bool(data: Any) -> Optional[str]:
+    """Returns value as boolean text.
+    """
+    if data is None:
+        return None
+    return bool(data) and 't' or 'f'
+
+
+def hash32_text(data: Any) -> Optional[str]:
+    """Returns hash32 as text for COPY.
+    """
+    if data is None:
+        return None
+    return str(hash32(data))
+
+
+def hash64_text(data: Any) -> Optional[str]:
+    """Returns hash64 as text for COPY.
+    """
+    if data is None:
+        return None
+    return str(hash64(data))
+
+
+def data_to_vals(data: str) -> List[Optional[str]]:
+    """Convert data received from copy to list of values
     """
     if data[-1] == '\n':
         data = data[:-1]
+    return [skytools.unescape_copy(value) for value in data.split('\t')]
 
-    vals = [skytools.unescape_copy(value) for value in data.split('\t')]
-    row = dict(zip(column_list, vals))
-    return row
+
+def data_to_dict(data: str, column_list: Sequence[str]) -> Dict[str, Any]:
+    """Convert data received from copy to dict
+    """
+    return dict(zip(column_list, data_to_vals(data)))
 
 
 def obf_vals_to_data(obf_vals: Sequence[Optional[str]]) -> str:
@@ -153,19 +221,71 @@ def obf_json(json_data: Any, rule_data: RuleDict) -> Any:
     raise ValueError('Invalid rule value: %r' % rule_data)
 
 
+def json_leaf_func(rule: str) -> Optional[ObfFunc]:
+    """Return function for leaf rule in json rules, None for skip.
+    """
+    if rule == KEEP:
+        return obf_keep
+    if rule == SKIP:
+        return None
+    func: ObfFunc
+    if rule == BOOL:
+        func = obf_bool
+    elif rule == HASH32:
+        func = hash32
+    elif rule == HASH64:
+        func = hash64
+    elif rule == HASH128:
+        func = hash128
+    else:
+        raise ValueError('Invalid rule value: %r' % rule)
+    return lambda data: None if isinstance(data, (dict, list)) else func(data)
+
+
+def compile_json_rules(rule_data: Any) -> Optional[ObfFunc]:
+    """Turn json rules into function that does obf_json(), None for skip.
+
+    >>> compile_json_rules({'a': 'keep', 'b': 'hash'})({'a': 1, 'b': 2, 'c': 3})
+    {'a': 1, 'b': 'da0f3012-9a91-a079-484b-883a64e535df'}
+    >>> compile_json_rules({'a': {'b': {'c': 'skip'}}, 'd': 'keep'})({'a': {'b': {'c': 3}}, 'd': []})
+    {'d': []}
+    """
+    if not isinstance(rule_data, dict):
+        return json_leaf_func(rule_data)
+
+    rules: List[Tuple[str, ObfFunc]] = []
+    for rule_key, rule_value in rule_data.items():
+        func = compile_json_rules(rule_value)
+        if func is not None:
+            rules.append((rule_key, func))
+
+    def obf_dict(json_data: Any) -> Optional[Dict[str, Any]]:
+        if not isinstance(json_data, dict):
+            return None
+        result = {}
+        for rule_key, func in rules:
+            val = func(json_data.get(rule_key))
+            if val is not None:
+                result[rule_key] = val
+        return result or None
+    return obf_dict
+
+
 class Obfuscator(TableHandler):
     """Default Londiste handler, inserts events into tables with plain SQL.
     """
     handler_name = 'obfuscate'
     obf_map: Dict[str, RuleDict] = {}
 
+    # obfuscation functions, valid while map stays same
+    row_funcs: Optional[Tuple[RuleDict, Dict[str, Optional[ObfFunc]]]] = None
+    copy_funcs: Optional[Tuple[RuleDict, Sequence[str], List[Optional[ObfFunc]]]] = None
+
     @classmethod
     def load_conf(cls, cf: skytools.Config) -> None:
-        global _KEY
-
-        _KEY = as_bytes(cf.get('obfuscator_key', ''))
+        set_key(as_bytes(cf.get('obfuscator_key', '')))
         with open(cf.getfile('obfuscator_map'), 'r', encoding="utf8") as f:
-            cls.obf_map = yaml.safe_load(f)
+            cls.obf_map = yaml.load(f, Loader=_YAML_LOADER)
 
     def _get_map(self, src_tablename: str, row: Optional[Dict[str, Any]] = None) -> RuleDict:
         """Can be over ridden in inherited classes to implemnt data driven maps
@@ -182,37 +302,73 @@ class Obfuscator(TableHandler):
         row = super().parse_row_data(ev)
 
         rule_data = self._get_map(self.table_name, row)
+        funcs = self.get_row_funcs(rule_data)
         dst: Dict[str, Any] = {}
         for field, value in row.items():
-            action = rule_data.get(field, SKIP)
-            if isinstance(action, dict):
-                dst[field] = self.obf_json(value, action)
-            elif action == KEEP:
-                dst[field] = value
-            elif action == SKIP:
-                continue
-            elif action == BOOL:
-                if value is None:
-                    dst[field] = value
-                else:
-                    dst[field] = bool(value) and 't' or 'f'
-            elif action == HASH32:
-                dst[field] = hash32(value)
-            elif action == HASH64:
-                dst[field] = hash64(value)
-            elif action == HASH128:
-                dst[field] = hash128(value)
-            else:
-                raise ValueError('Invalid value for action: %r' % action)
+            try:
+                func = funcs[field]
+            except KeyError:
+                func = funcs[field] = self.obf_func(rule_data.get(field, SKIP))
+            if func is not None:
+                dst[field] = func(value)
         return dst
 
+    def obf_func(self, action: Any, as_text: bool = False) -> Optional[ObfFunc]:
+        """Return function that applies action to one value, None for skipped field.
+
+        With as_text, hashes are returned as text for COPY.
+        """
+        if isinstance(action, dict):
+            if type(self).obf_json is not Obfuscator.obf_json:
+                # subclass has own json handling
+                obf_json = self.obf_json
+                return lambda value: obf_json(value, action)
+            json_func = compile_json_rules(action)
+            obf_json_compiled = self.obf_json_compiled
+            return lambda value: obf_json_compiled(value, json_func)
+        if action == KEEP:
+            return obf_keep
+        if action == SKIP:
+            return None
+        if action == BOOL:
+            return obf_bool
+        if action == HASH32:
+            return hash32_text if as_text else hash32
+        if action == HASH64:
+            return hash64_text if as_text else hash64
+        if action == HASH128:
+            return hash128
+        raise ValueError('Invalid value for action: %r' % action)
+
+    def get_row_funcs(self, rule_data: RuleDict) -> Dict[str, Optional[ObfFunc]]:
+        """Per-field functions for event rows, filled in as fields are seen.
+        """
+        cached = self.row_funcs
+        if cached is None or cached[0] is not rule_data:
+            cached = self.row_funcs = (rule_data, {})
+        return cached[1]
+
+    def get_copy_funcs(self, obf_col_map: RuleDict, column_list: Sequence[str]) -> List[Optional[ObfFunc]]:
+        """Functions for COPY rows, in column_list order.
+        """
+        cached = self.copy_funcs
+        if cached is None or cached[0] is not obf_col_map or cached[1] is not column_list:
+            funcs = [self.obf_func(obf_col_map.get(col, SKIP), True) for col in column_list]
+            cached = self.copy_funcs = (obf_col_map, column_list, funcs)
+        return cached[2]
+
     def obf_json(self, value: Any, rule_data: RuleDict) -> Optional[str]:
         """Recursive obfuscate for json
         """
+        return self.obf_json_compiled(value, compile_json_rules(rule_data))
+
+    def obf_json_compiled(self, value: Any, json_func: Optional[ObfFunc]) -> Optional[str]:
+        """Obfuscate json text with function from compile_json_rules()
+        """
         if value is None:
             return None
-        json_data = json.loads(value)
-        obf_data = obf_json(json_data, rule_data)
+        json_data = json_loads(value)
+        obf_data = json_func(json_data) if json_func else None
         if obf_data is None:
             obf_data = {}
         return json.dumps(obf_data)
@@ -220,39 +376,14 @@ class Obfuscator(TableHandler):
     def obf_copy_row(self, data: str, column_list: Sequence[str], src_tablename: str) -> str:
         """Apply obfuscation to one row
         """
-        row = data_to_dict(data, column_list)
+        vals = data_to_vals(data)
+        row = dict(zip(column_list, vals))
         obf_col_map = self._get_map(src_tablename, row)
+        funcs = self.get_copy_funcs(obf_col_map, column_list)
 
-        obf_vals: List[Optional[str]] = []
-        for field, value in row.items():
-            action = obf_col_map.get(field, SKIP)
-
-            if isinstance(action, dict):
-                obf_val = self.obf_json(value, action)
-                obf_vals.append(obf_val)
-                continue
-            elif action == KEEP:
-                obf_vals.append(value)
-                continue
-            elif action == SKIP:
-                continue
-
-            if value is None:
-                obf_vals.append(value)
-            elif action == BOOL:
-                obf_val = str(bool(value) and 't' or 'f')
-                obf_vals.append(obf_val)
-            elif action == HASH32:
-                obf_val = str(hash32(value))
-                obf_vals.append(obf_val)
-            elif action == HASH64:
-                obf_val = str(hash64(value))
-                obf_vals.append(obf_val)
-            elif action == HASH128:
-                obf_val = hash128(value)
-                obf_vals.append(obf_val)
-            else:
-                raise ValueError('Invalid value for action: %s' % action)
+        obf_vals: List[Optional[str]] = [
+            func(value) for func, value in zip(funcs, vals) if func is not None
+        ]
 
         obf_data = obf_vals_to_data(obf_vals)
         return obf_data
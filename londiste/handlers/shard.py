@@ -48,7 +48,7 @@ class ShardHandler(TableHandler):
 
     DEFAULT_HASH_EXPR = "%s(%s)"
 
-    hash_key: str
+    hash_key: Optional[str]
     hash_expr: str
     disable_replay: bool
 
@@ -56,10 +56,8 @@ class ShardHandler(TableHandler):
         super().__init__(table_name, args, dest_table)
 
         # primary key columns
-        hash_key = args.get('hash_key', args.get('key'))
-        if hash_key is None:
-            raise Exception('Specify hash key field as hash_key argument')
-        self.hash_key = hash_key
+        self.hash_key = args.get('hash_key', args.get('key'))
+        self._validate_hash_key()
 
         # hash function & full expression
         self.hash_expr = self.DEFAULT_HASH_EXPR % (
@@ -70,6 +68,10 @@ class ShardHandler(TableHandler):
         disable_replay = args.get('disable_replay', 'false')
         self.disable_replay = disable_replay in ('true', '1')
 
+    def _validate_hash_key(self) -> None:
+        if self.hash_key is None:
+            raise Exception('Specify hash key field as hash_key argument')
+
     @classmethod
     def load_conf(cls, cf: skytools.Config) -> None:
         global _SHARD_HASH_FUNC, _SHARD_INFO_SQL
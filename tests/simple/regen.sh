@@ -151,6 +151,21 @@ run londiste $v conf/londiste_db5.ini wait-root
 run londiste $v conf/londiste_db5.ini add-table mytable2 --find-copy-node
 run londiste $v conf/londiste_db5.ini wait-sync
 
+# MERGE statement needs PostgreSQL 15+
+if test "$(psql -qAt -d db2 -c 'show server_version_num')" -ge 150000; then
+  msg "Test bulk load with merge method"
+  run psql -d db1 -c "create table mytable3 (id int4 primary key, data text)"
+  run psql -d db1 -c "insert into mytable3 select n, 'row' || n from generate_series(1, 10) n"
+  run londiste $v conf/londiste_db1.ini add-table mytable3
+  run londiste $v conf/londiste_db2.ini add-table mytable3 --create --handler=bulk_direct --handler-arg="method=4"
+  run londiste $v conf/londiste_db2.ini wait-sync
+  run psql -d db1 -c "update mytable3 set data = data || '.upd' where id <= 5"
+  run psql -d db1 -c "delete from mytable3 where id > 8"
+  run psql -d db1 -c "insert into mytable3 (id, data) values (11, 'row11')"
+  run sleep 10
+  run londiste conf/londiste_db2.ini compare mytable3
+fi
+
 ##
 ## basic setup done
 ##